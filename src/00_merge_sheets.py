@@ -2,34 +2,140 @@ import yaml
 import argparse
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
+import cache
+import profiling
+import workbook
 
-def merge_sheets(f, save_path):
-    patient = pd.read_excel(f, sheet_name='patient')
-    registratie = pd.read_excel(f, sheet_name='registratie')
-    episode = pd.read_excel(f, sheet_name='episode')
+
+episode_sheets = [
+    'chirurgie','radiotherapie','rfa','opname','chirurgie_ii',
+    'tussklaar','fup','braf_dosisaanpassing','mek_dosisaanpassing',
+    'anti_pd_1_dosisaanpassing','ipnicomb_uitstel','ipniond_uitstel'
+]
+
+# the followup sheet holds the assessments the selection is based on, so it keeps one row per followup
+# when the other episode sheets are aggregated
+long_sheets = ['fup']
+
+# columns every sheet needs for the joins
+keys = {
+    'patient': ['uri'],
+    'registratie': ['uri', 'patient_uri'],
+    'episode': ['uri', 'registratie_uri'],
+    **{sheet_name: ['episode_uri'] for sheet_name in episode_sheets}
+}
+
+
+def read_sheets(f, sheet_columns=None, cache_options=None):
+    # all sheets are read in one pass over the workbook. sheet_columns optionally limits the
+    # columns that are read from a sheet, sheets that are not listed are read completely
+    cache_options = cache_options or {}
+    sheet_columns = sheet_columns or {}
+    sheets = {
+        sheet_name: key + sheet_columns[sheet_name] if sheet_name in sheet_columns else None
+        for sheet_name, key in keys.items()
+    }
+    return cache.read(f, reader=workbook.read_sheets, sheets=sheets, **cache_options)
+
+
+def aggregate_sheet(sheet, sheet_name):
+    # one row per episode, with the first value of every column and the number of rows of the episode
+    grouped = sheet.groupby('episode_uri', sort=False)
+    aggregated = grouped.first()
+    aggregated[f'{sheet_name}_rows'] = grouped.size()
+    return aggregated
+
+
+def to_parquet(df, save_path):
+    # parquet needs a single type per column, columns that mix e.g. numbers and text are stored as text
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in ['string', 'empty']:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.to_parquet(save_path)
+
+
+def merge_workbook(f, cache_options=None, sheet_columns=None, aggregate=False):
+    with profiling.stage('load') as record:
+        sheets = read_sheets(f, sheet_columns, cache_options)
+        record['rows_out'] = sum(len(sheet) for sheet in sheets.values())
+
+    patient = sheets['patient']
+    registratie = sheets['registratie']
+    episode = sheets['episode']
 
     patient = patient.rename(columns={'uri':'patient_uri'})
     registratie = registratie.rename(columns={'uri':'registratie_uri'})
     episode = episode.rename(columns={'uri':'episode_uri'})
 
-    df = patient.join(registratie.set_index('patient_uri'), on='patient_uri', rsuffix='_registratie')
-    df = df.join(episode.set_index('registratie_uri'), on='registratie_uri', rsuffix='_episode')
+    with profiling.stage('merge', len(patient)) as record:
+        df = patient.join(registratie.set_index('patient_uri'), on='patient_uri', rsuffix='_registratie')
+        df = df.join(episode.set_index('registratie_uri'), on='registratie_uri', rsuffix='_episode')
+        record['rows_out'] = len(df)
+
+    # every episode sheet can have several rows per episode, so joining them all multiplies the rows
+    # of an episode. With aggregate, only the long sheets keep their rows and the other sheets are
+    # reduced to one row per episode first, so the output grows linearly with the input.
+    with profiling.stage('merge_episode_sheets', len(df)) as record:
+        for sheet_name in episode_sheets:
+            if aggregate and sheet_name not in long_sheets:
+                sheet = aggregate_sheet(sheets[sheet_name], sheet_name)
+            else:
+                sheet = sheets[sheet_name].set_index('episode_uri')
+            df = df.join(sheet, on='episode_uri', rsuffix=f"_{sheet_name}")
+        record['rows_out'] = len(df)
+
+    return df
+
 
-    episode_sheets = [
-        'chirurgie','radiotherapie','rfa','opname','chirurgie_ii',
-        'tussklaar','fup','braf_dosisaanpassing','mek_dosisaanpassing',
-        'anti_pd_1_dosisaanpassing','ipnicomb_uitstel','ipniond_uitstel'
-    ]
+def merge_sheets(f, save_path, cache_options=None, sheet_columns=None, aggregate=False):
+    df = merge_workbook(f, cache_options, sheet_columns, aggregate)
 
-    for sheet_name in episode_sheets:
-        sheet = pd.read_excel(f, sheet_name=sheet_name).set_index('episode_uri')
-        df = df.join(sheet, on='episode_uri', rsuffix=f"_{sheet_name}")
+    with profiling.stage('write', len(df)):
+        if Path(save_path).suffix == '.parquet':
+            to_parquet(df, save_path)
+        else:
+            df.to_csv(save_path)
 
-    df.to_csv(save_path)
+
+def merge_file(multiple_sheets_file, config, cache_options, output_format='csv', aggregate=False, profile=False):
+    save_path = Path(config['input_folder']) / (multiple_sheets_file.stem + '.' + output_format)
+
+    with profiling.profile(profile, center=multiple_sheets_file.name) as report:
+        merge_sheets(
+            multiple_sheets_file,
+            save_path,
+            cache_options,
+            config.get('sheet_columns'),
+            aggregate
+        )
+
+    return report
 
 parser = argparse.ArgumentParser()
 parser.add_argument("config_name")
+parser.add_argument("--no-cache", action="store_true")
+parser.add_argument("--profile", action="store_true")
+parser.add_argument(
+    "--aggregate",
+    action="store_true",
+    help="reduce every episode sheet except fup to one row per episode before merging"
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of workbooks to merge in parallel"
+)
+parser.add_argument(
+    "--format",
+    choices=["csv", "parquet"],
+    default="csv",
+    help="parquet keeps the dtypes of the merged columns, and is read directly by 01_preprocess.py"
+)
 
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -37,9 +143,25 @@ if __name__ == "__main__":
     with open(f"../config/{args.config_name}") as f:
         config = yaml.safe_load(f)
 
-    for multiple_sheets_file in Path(config['multiple_sheet_files_folder']).iterdir():
+    multiple_sheets_files = list(Path(config['multiple_sheet_files_folder']).iterdir())
+    for multiple_sheets_file in multiple_sheets_files:
         print(f'Merging {multiple_sheets_file.name}')
 
-        save_path = Path(config['input_folder']) / (multiple_sheets_file.stem + '.csv')
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    reports = list((pool.map if pool else map)(
+        merge_file,
+        multiple_sheets_files,
+        repeat(config),
+        repeat(cache.options_from_config(config, args.no_cache)),
+        repeat(args.format),
+        repeat(args.aggregate),
+        repeat(args.profile)
+    ))
+    if pool:
+        pool.shutdown()
+
+    if args.profile:
+        for multiple_sheets_file, report in zip(multiple_sheets_files, reports):
+            profiling.write(report, config['intermediate_output_folder'], '00_merge_sheets/' + multiple_sheets_file.stem)
 
-        merge_sheets(multiple_sheets_file, save_path)
+        profiling.summarize(reports, config['intermediate_output_folder'], '00_merge_sheets/summary')
@@ -3,333 +3,396 @@ import argparse
 import numpy as np
 import yaml
 from pathlib import Path
-import datetime
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+import contextlib
+import io
+import sys
+import tempfile
+import time
+import traceback
 import warnings
 
+import cache
+import delta
+import manifest
+import polars_backend
+import profiling
+import rules
+import schema
+
 warnings.filterwarnings("ignore")
 
 
-def select(dataset):
-    # find patients+episode treated with anti-pd1 or combination therapy, but exclude episodes with prior treatment
-    grouped = dataset.groupby(["upn", "episodevolgnr"], sort=True).typsyth1.apply(list)
+def find_episodes(dataset):
+    # flag the therapies given in every (upn, episode), shared by both cohorts
+    return (
+        dataset[["upn", "episodevolgnr"]]
+        .assign(
+            **{
+                therapy: dataset["typsyth1"].isin(codes)
+                for therapy, codes in rules.THERAPIES.items()
+            }
+        )
+        .groupby(["upn", "episodevolgnr"], sort=True)
+        .any()
+    )
 
-    included_patients = []
-    pretreated = []
-    excluded_because_of_pretreatment = []
 
-    for (upn, episode), row in zip(grouped.index, grouped):
-        if any([th in [5, 6] for th in row]):
-            if not upn in pretreated:
-                included_patients.append((upn, episode))
-            else:
-                if upn not in excluded_because_of_pretreatment:
-                    excluded_because_of_pretreatment.append(upn)
-        if any([th in [2, 3, 4, 5, 6, 7, 10] for th in row]):
-            pretreated.append(upn)
-
-    print(
-        "Patients treated with anti-PD1/combination therapy: {}".format(
-            len(excluded_because_of_pretreatment) + len(included_patients)
-        )
+def select_treatment_lines(episodes, therapy, prior_therapy):
+    # a patient is pretreated at an episode if any earlier episode contained prior therapy
+    pretreated = (
+        prior_therapy.groupby(level="upn")
+        .shift(fill_value=False)
+        .astype(int)
+        .groupby(level="upn")
+        .cummax()
+        .astype(bool)
     )
-    print("Not treatment-naive: {}".format(len(excluded_because_of_pretreatment)))
 
-    selected = dataset[
-        dataset[["upn", "episodevolgnr"]].apply(tuple, axis=1).isin(included_patients)
-    ]
+    included = episodes.index[therapy & ~pretreated]
+    excluded = episodes.index[therapy & pretreated]
+    return included, pd.unique(excluded.get_level_values("upn"))
+
+
+def filter_episodes(dataset, episodes):
+    # keep the rows of the given (upn, episode) pairs through an index lookup
+    keys = pd.MultiIndex.from_frame(dataset[["upn", "episodevolgnr"]])
+    return dataset[keys.isin(episodes)]
+
+
+def row_min(df):
+    # nan-aware minimum over the columns of every row, for columns of the same datetime or timedelta dtype
+    return pd.Series(np.nanmin(df.to_numpy(), axis=1), index=df.index)
+
+
+def row_max(df):
+    return pd.Series(np.nanmax(df.to_numpy(), axis=1), index=df.index)
+
+
+def find_start_date(dataset):
+    # the start of treatment is the earliest of the therapy start dates
+    return row_min(dataset[["startpd", "startipnicomb", "startandst"]])
+
 
-    # exclude patients with ocular or mucosal melanoma
-    before = len(pd.unique(selected["upn"]))
-    selected = selected[~selected["ptloc"].isin([1, 6])]
-    after = len(pd.unique(selected["upn"]))
-    print("With ocular or mucosal melanoma: {}".format(before - after))
-
-    # exclude patients with start date before 1-1-2016
-    before = len(pd.unique(selected["upn"]))
-    selected["start_date"] = (
-        pd.to_datetime(selected[["startpd", "startipnicomb", "startandst"]].stack())
-        .unstack()
-        .min(axis=1)
+def report_excluded(step, patients, funnel=None):
+    # when the dataset is processed in buckets, the counts are added up in funnel and reported at the end
+    if funnel is not None:
+        funnel[step] = funnel.get(step, 0) + patients
+        return
+    print("{}: {}".format(step, patients))
+    profiling.funnel(step, patients)
+
+
+def excluded(dataset, column, condition, value):
+    # the rows an exclusion rule applies to
+    if condition == "isin":
+        return dataset[column].isin(value)
+    if condition == "before":
+        return dataset[column] < np.datetime64(value)
+    return dataset[column].notnull()
+
+
+def treatment_lines(episodes, cohort):
+    therapy, prior_therapy = rules.TREATMENT_LINES[cohort]
+    return select_treatment_lines(
+        episodes, episodes[therapy], episodes[prior_therapy].any(axis=1)
     )
-    selected = selected.loc[~(selected["start_date"] < np.datetime64("2016-01-01"))]
-    after = len(pd.unique(selected["upn"]))
 
-    print("Treated before 1-1-2016: {}".format(before - after))
 
-    # # exclude patients with sysadj
-    before = len(pd.unique(selected["upn"]))
-    selected = selected[selected["sysadj"].isnull()]
-    after = len(pd.unique(selected["upn"]))
-    print("Treated in (neo-)adjuvant setting: {}".format(before - after))
+def select(dataset, episodes, funnel=None):
+    # find patients+episode treated with anti-pd1 or combination therapy, but exclude episodes with prior treatment
+    included_patients, excluded_because_of_pretreatment = treatment_lines(
+        episodes, "included"
+    )
 
-    print("Remaining: {}".format(after))
+    report_excluded(
+        "Patients treated with anti-PD1/combination therapy",
+        len(excluded_because_of_pretreatment) + len(included_patients),
+        funnel,
+    )
+    report_excluded(
+        "Not treatment-naive", len(excluded_because_of_pretreatment), funnel
+    )
+
+    selected = filter_episodes(dataset, included_patients)
+
+    # exclude patients with ocular or mucosal melanoma, treated before 1-1-2016 or with sysadj
+    for step, column, condition, value in rules.EXCLUSIONS["included"]:
+        before = len(pd.unique(selected["upn"]))
+        selected = selected[~excluded(selected, column, condition, value)]
+        after = len(pd.unique(selected["upn"]))
+        report_excluded(step, before - after, funnel)
+
+    report_excluded("Remaining", after, funnel)
     return selected
 
 
-def select_possible(dataset):
-    grouped = dataset.groupby(["upn", "episodevolgnr"], sort=True).typsyth1.apply(list)
+def select_possible(dataset, episodes):
+    included_patients, _ = treatment_lines(episodes, "possible")
 
-    included_patients = []
-    pretreated = []
+    possible = filter_episodes(dataset, included_patients)
 
-    for (upn, episode), row in zip(grouped.index, grouped):
-        if any([th in [7] for th in row]) and not upn in pretreated:
-            included_patients.append((upn, episode))
-        if any([th in [2, 3, 4, 5, 6, 10] for th in row]):
-            pretreated.append(upn)
+    # exclude patients with start date before 1-1-2016 or with sysadj
+    for _, column, condition, value in rules.EXCLUSIONS["possible"]:
+        possible = possible[~excluded(possible, column, condition, value)]
 
-    possible = dataset[
-        dataset[["upn", "episodevolgnr"]].apply(tuple, axis=1).isin(included_patients)
-    ]
+    return possible
+
+
+Timeline = namedtuple("Timeline", ["indptr", "status", "days"])
 
-    # exclude patients with start date before 1-1-2016
-    possible["start_date"] = (
-        pd.to_datetime(possible[["startpd", "startipnicomb", "startandst"]].stack())
-        .unstack()
-        .min(axis=1)
+
+def build_timeline(baseline, dataset):
+    # lay out the followup of every baseline patient as one contiguous block (CSR style):
+    # the assessments of patient i are status[indptr[i]:indptr[i + 1]], sorted by days since start
+    keys = baseline.reset_index()[["upn", "episodevolgnr", "start_date"]]
+    keys["patient"] = np.arange(len(keys))
+
+    followup = dataset[["upn", "episodevolgnr", "statlcont", "datlcont"]].assign(
+        position=np.arange(len(dataset))
     )
-    possible = possible.loc[~(possible["start_date"] < np.datetime64("2016-01-01"))]
+    followup = followup.merge(keys, on=["upn", "episodevolgnr"], how="inner")
 
-    # exclude patients with sysadj
-    possible = possible[possible["sysadj"].isnull()]
+    patient = followup["patient"].to_numpy()
+    status = followup["statlcont"].to_numpy(dtype=float)
+    days = (followup["datlcont"] - followup["start_date"]) / np.timedelta64(1, "D")
+    days = days.to_numpy(dtype=float)
 
-    return possible
+    # assessments without a date sort to the end of their block, ties keep the order of the dataset
+    order = np.lexsort((followup["position"].to_numpy(), days, patient))
+    indptr = np.searchsorted(patient[order], np.arange(len(keys) + 1))
 
+    return Timeline(indptr, status[order], days[order])
 
-def determine_benefit(patient):
-    if pd.isna(patient.start_date):
-        return float("nan")
-    try:
-        relative_time = [
-            (fu[0], fu[1] - np.datetime64(patient.start_date))
-            for fu in patient.followup
-        ]
-    except:
-        return float("nan")
 
-    # if there was response at any time, there is clinical benefit
-    if any(
-        [
-            moment[0]
-            in [
-                6,
-                8,
-            ]
-            for moment in relative_time
-        ]
-    ):
-        return 1
-
-    # stable disease at 24 weeks counts as clinical benefit
-    late_assessments = [
-        moment
-        for moment in relative_time
-        if moment[1] >= datetime.timedelta(days=7 * 24)
+def _any_status(timeline, codes):
+    patient = np.repeat(np.arange(len(timeline.indptr) - 1), np.diff(timeline.indptr))
+    hits = np.isin(timeline.status, codes)
+    return np.bincount(patient, weights=hits, minlength=len(timeline.indptr) - 1) > 0
+
+
+def _first_late_assessment(timeline, days=7 * 24):
+    # within a block the assessments are sorted by time, so the first assessment at or after
+    # the cutoff directly follows the early ones
+    n_patients = len(timeline.indptr) - 1
+    patient = np.repeat(np.arange(n_patients), np.diff(timeline.indptr))
+    early = np.bincount(patient, weights=timeline.days < days, minlength=n_patients)
+    late = np.bincount(patient, weights=timeline.days >= days, minlength=n_patients)
+
+    has_late = late > 0
+    first = np.full(n_patients, np.nan)
+    first[has_late] = timeline.status[
+        timeline.indptr[:-1][has_late] + early[has_late].astype(int)
     ]
+    return has_late, first
 
-    if late_assessments:
-        first_assessment_after_24weeks = sorted(late_assessments, key=lambda x: x[1])[
-            0
-        ][0]
-        # if the first assessment after 24 weeks showed response, there is benefit
-        if first_assessment_after_24weeks in [2, 3]:
-            return 1
-        # otherwise, there has to be progression and there is no benefit
-        else:
-            return 0
-    else:
-        # if followup is less than 24 weeks...
-        if 5 in [x[0] for x in patient.followup] and patient.doodoorz not in [
-            2,
-            3,
-            7,
-        ]:  # and the patient died, but not of something else
-            return 0
-        elif 4 in [x[0] for x in patient.followup]:  # or if the patient progressed
-            return 0
-        else:
-            return float("nan")
 
-    # if there was progressive disease at any time in other cases, there is no clinical benefit
-    # if any([moment[0] in [4,5] for moment in relative_time]):
-    #     return 0
+def _progressed_or_died(timeline, baseline):
+    # the patient died, but not of something else, or the patient progressed
+    died = _any_status(timeline, [5]) & ~baseline["doodoorz"].isin([2, 3, 7]).to_numpy()
+    return died | _any_status(timeline, [4])
 
-    return "error"
 
+def determine_benefit(timeline, baseline):
+    has_late, first_late = _first_late_assessment(timeline)
 
-def determine_response(patient):
-    if pd.isna(patient.start_date):
-        return float("nan")
-    try:
-        relative_time = [
-            (fu[0], fu[1] - np.datetime64(patient.start_date))
-            for fu in patient.followup
-        ]
-    except:
-        return float("nan")
-
-    # if there was response at any time, there is response
-    if any([moment[0] in [1, 6, 8] for moment in relative_time]):
-        return 1
-
-    # stable disease at 24 weeks counts as clinical benefit
-    late_assessments = [
-        moment
-        for moment in relative_time
-        if moment[1] >= datetime.timedelta(days=7 * 24)
-    ]
+    return np.select(
+        [
+            baseline["start_date"].isna().to_numpy(),
+            # if there was response at any time, there is clinical benefit
+            _any_status(timeline, [6, 8]),
+            # stable disease at 24 weeks counts as clinical benefit
+            has_late & np.isin(first_late, [2, 3]),
+            # otherwise, there has to be progression and there is no benefit
+            has_late,
+            # if followup is less than 24 weeks, there is no benefit if the patient died or progressed
+            _progressed_or_died(timeline, baseline),
+        ],
+        [np.nan, 1, 1, 0, 0],
+        np.nan,
+    )
 
-    if late_assessments:
-        # if followup is more than 24 weeks...
-        # ... the patient did not achieve response (as per condition above and thus 0)
-        return 0
-    else:
-        # if followup is less than 24 weeks...
-        if 5 in [x[0] for x in patient.followup] and patient.doodoorz not in [
-            2,
-            3,
-            7,
-        ]:  # and the patient died, but not of something else
-            return 0
-        elif 4 in [x[0] for x in patient.followup]:  # or if the patient progressed
-            return 0
-        else:
-            return float("nan")
 
-    # if there was progressive disease at any time in other cases, there is no clinical benefit
-    # if any([moment[0] in [4,5] for moment in relative_time]):
-    #     return 0
+def determine_response(timeline, baseline):
+    has_late, _ = _first_late_assessment(timeline)
+
+    return np.select(
+        [
+            baseline["start_date"].isna().to_numpy(),
+            # if there was response at any time, there is response
+            _any_status(timeline, [1, 6, 8]),
+            # if followup is more than 24 weeks, the patient did not achieve response
+            has_late,
+            # if followup is less than 24 weeks, there is no response if the patient died or progressed
+            _progressed_or_died(timeline, baseline),
+        ],
+        [np.nan, 1, 0, 0],
+        np.nan,
+    )
+
 
-    return "error"
+def baseline_rows(dataset):
+    # the entries at the earliest contact of every patient. A patient whose first entry has no
+    # contact date keeps their undated entries, like the min over the list of dates did
+    undated = dataset["datlcont"].isna()
+    first_undated = undated.groupby(dataset["upn"]).transform("first").fillna(False)
+    earliest = (
+        dataset.groupby("upn")["datlcont"]
+        .transform("min")
+        .mask(first_undated.astype(bool))
+    )
+    return dataset[(dataset["datlcont"] == earliest) | (earliest.isna() & undated)]
 
 
 def find_baseline_entry(dataset):
-    # take the first entry in the episode
-    starting_dates = (
-        # dataset[~dataset["datlcont"].isna()].groupby("upn").datlcont.apply(min)
-        dataset.groupby("upn")
-        .datlcont.apply(list)
-        .apply(lambda x: [pd.to_datetime(el) for el in x])
-        .apply(min)
+    # take the first entry at the earliest contact of every patient. The coded fields get their
+    # plain dtypes first, groupby().first() is slow on categoricals
+    baseline = schema.expand(baseline_rows(dataset)).groupby("upn").first()
+
+    # add all followup to the baseline entry
+    followup = (
+        pd.Series(
+            list(zip(dataset["statlcont"], dataset["datlcont"])), index=dataset.index
+        )
+        .groupby([dataset["upn"], dataset["episodevolgnr"]])
+        .agg(list)
+        .rename("followup")
     )
-    upn_vs_start = list(zip(starting_dates.index, starting_dates))
-    dataset["datlcont"] = pd.to_datetime(dataset["datlcont"])
-    baseline = dataset[
-        dataset[["upn", "datlcont"]].apply(tuple, axis=1).isin(upn_vs_start)
+    baseline = (
+        baseline.reset_index()
+        .merge(followup, on=["upn", "episodevolgnr"], how="left")
+        .set_index("upn")
+    )
+    baseline["followup"] = [
+        fu if isinstance(fu, list) else [] for fu in baseline["followup"]
     ]
 
-    baseline = baseline.groupby("upn").first()
+    return baseline
 
-    # add all followup to the baseline entry
-    grouped = dataset.groupby(["upn", "episodevolgnr"])[
-        ["statlcont", "datlcont"]
-    ].apply(lambda x: list(zip(list(x["statlcont"]), list(x["datlcont"]))))
 
-    followup = []
-    for _, row in baseline.reset_index().iterrows():
-        try:
-            fu = grouped.loc[(row["upn"], row["episodevolgnr"])]
-            followup.append(fu)
-        except:
-            followup.append([])
+def add_columns(baseline, rows, columns):
+    # add the columns that were not read up front, taken from the same entries as the baseline
+    # entry, and put them in the order of the input file
+    first = (
+        schema.expand(columns.loc[rows.index].drop(columns="upn"))
+        .groupby(rows["upn"])
+        .first()
+    )
+    baseline = baseline.join(first[first.columns.difference(baseline.columns)])
 
-    baseline["followup"] = followup
+    order = [col for col in columns.columns if col in baseline.columns]
+    return baseline[order + list(baseline.columns.difference(order, sort=False))]
 
-    # determine durable clinical benefit
-    benefits = []
-    for _, row in baseline[["id", "start_date", "followup", "doodoorz"]].iterrows():
-        benefits.append(determine_benefit(row))
-    baseline["dcb"] = benefits
 
-    # determine response
-    responses = []
-    for _, row in baseline[["id", "start_date", "followup", "doodoorz"]].iterrows():
-        responses.append(determine_response(row))
-    baseline["orr"] = responses
+def add_endpoints(baseline, dataset):
+    # determine durable clinical benefit and response over the followup of every patient
+    timeline = build_timeline(baseline, dataset)
+    baseline["dcb"] = determine_benefit(timeline, baseline)
+    baseline["orr"] = determine_response(timeline, baseline)
 
     return baseline
 
 
-def preprocess(baseline, selected, dataset):
-    stages = []
-    for upn, row in baseline.iterrows():
-        if row["locafmethersen"] == 1:
-            stages.append("M1d")
-        elif any(
-            row[["locafmetlever", "locafmetdarm", "locafmetbot", "locafmetand"]] == 1
-        ):
-            stages.append("M1c")
-        elif row["locafmetlong"] == 1:
-            stages.append("M1b")
-        elif any(row[["locafmetlklier", "locafmetcutis"]] == 1):
-            stages.append("M1a")
-        elif row["lokrec"] == 1:
-            stages.append("IIIC")
-        else:
-            stages.append(float("nan"))
-    baseline["stage"] = stages
-
-    baseline["Best overall response"] = [float("nan")] * len(baseline)
-
-    responses_data = selected.groupby("upn").statlcont.apply(list)
-    for upn, responses in zip(responses_data.index, responses_data):
-        if any([r in [1, 8] for r in responses]):
-            bor = "Complete response"  # CR
-        elif 6 in responses:
-            bor = "Partial response"  # PR
-        elif any([r in [2, 3] for r in responses]):
-            bor = "Stable disease"  # SD
-        elif (
-            4 in responses
-            or 1 in selected.groupby("upn")["doodoorz"].apply(list).loc[upn]
-        ):  # also if cause of death is melanoma
-            bor = "Progressive disease"  # PD
-        elif 5 in responses:
-            bor = "Death"  # Dead
-        elif 7 in responses:
-            bor = "Lost to follow up"  # LTFU
-        else:
-            bor = float("nan")
-        baseline.loc[upn, "Best overall response"] = bor
+def first_label(conditions, labels, index):
+    # label of the first condition that holds, nan where none of them do
+    return pd.Series(np.select(conditions, labels, default=None), index=index).fillna(
+        float("nan")
+    )
 
-    # find last date of followup
-    last_contact = dataset[~dataset["datlcont"].isna()].groupby("upn").datlcont.max()
-    baseline["last_contact"] = pd.to_datetime(
-        last_contact[last_contact.index.isin(baseline.index)]
+
+def preprocess(baseline, selected, last_contact):
+    metastases = baseline[
+        [
+            "locafmethersen",
+            "locafmetlever",
+            "locafmetdarm",
+            "locafmetbot",
+            "locafmetand",
+            "locafmetlong",
+            "locafmetlklier",
+            "locafmetcutis",
+            "lokrec",
+        ]
+    ].eq(1)
+    baseline["stage"] = first_label(
+        [
+            metastases["locafmethersen"],
+            metastases[
+                ["locafmetlever", "locafmetdarm", "locafmetbot", "locafmetand"]
+            ].any(axis=1),
+            metastases["locafmetlong"],
+            metastases[["locafmetlklier", "locafmetcutis"]].any(axis=1),
+            metastases["lokrec"],
+        ],
+        ["M1d", "M1c", "M1b", "M1a", "IIIC"],
+        baseline.index,
     )
 
-    # end of followup is the latter of moment of death or last contact
-    baseline["end_of_fu"] = (
-        pd.to_datetime(baseline[["last_contact", "datovl"]].stack())
-        .unstack()
-        .max(axis=1)
+    # for every patient, find whether any followup had a status (or cause of death) in a set of codes
+    responses = (
+        selected[["upn"]]
+        .assign(
+            complete=selected["statlcont"].isin([1, 8]),
+            partial=selected["statlcont"].isin([6]),
+            stable=selected["statlcont"].isin([2, 3]),
+            progressive=selected["statlcont"].isin([4]),
+            died_of_melanoma=selected["doodoorz"].isin([1]),
+            death=selected["statlcont"].isin([5]),
+            lost=selected["statlcont"].isin([7]),
+        )
+        .groupby("upn")
+        .any()
+        .reindex(baseline.index, fill_value=False)
+    )
+    baseline["Best overall response"] = first_label(
+        [
+            responses["complete"],  # CR
+            responses["partial"],  # PR
+            responses["stable"],  # SD
+            responses["progressive"]
+            | responses["died_of_melanoma"],  # PD, also if cause of death is melanoma
+            responses["death"],  # Dead
+            responses["lost"],  # LTFU
+        ],
+        [
+            "Complete response",
+            "Partial response",
+            "Stable disease",
+            "Progressive disease",
+            "Death",
+            "Lost to follow up",
+        ],
+        baseline.index,
     )
 
+    # find last date of followup
+    baseline["last_contact"] = last_contact[last_contact.index.isin(baseline.index)]
+
+    # end of followup is the latter of moment of death or last contact
+    baseline["end_of_fu"] = row_max(baseline[["last_contact", "datovl"]])
+
     # calculate duration of followup
-    baseline["fu_OS"] = pd.to_datetime(baseline["end_of_fu"]) - pd.to_datetime(
-        baseline["start_date"]
-    )
+    baseline["fu_OS"] = baseline["end_of_fu"] - baseline["start_date"]
 
     # for OS, event is defined as death
     baseline["event_OS"] = ~baseline["datovl"].isnull()
 
     # for PFS, event is defined as moment of progression or death
-    progressed = []
-    for upn, followup in selected.groupby("upn").statlcont.apply(list).items():
-        if any([fu in [4, 5] for fu in followup]):
-            progressed.append(True)
-        else:
-            progressed.append(False)
-    baseline["event_PFS"] = baseline["event_OS"] | progressed
+    baseline["event_PFS"] = (
+        baseline["event_OS"] | responses["progressive"] | responses["death"]
+    )
 
     # duration of followup is lesser of time to progression or time to death
     baseline["date_of_progression"] = (
         selected[selected["statlcont"].isin([4, 5])].groupby("upn")["datlcont"].min()
     )
-    baseline["time_to_progression"] = pd.to_datetime(
-        baseline["date_of_progression"]
-    ) - pd.to_datetime(baseline["start_date"])
-    baseline["fu_PFS"] = baseline[["time_to_progression", "fu_OS"]].min(axis=1)
+    baseline["time_to_progression"] = (
+        baseline["date_of_progression"] - baseline["start_date"]
+    )
+    baseline["fu_PFS"] = row_min(baseline[["time_to_progression", "fu_OS"]])
 
     # format column names and variable names
     baseline = baseline.rename(
@@ -355,19 +418,416 @@ def preprocess(baseline, selected, dataset):
 
     # add age
     if "gebdat" in baseline.columns:
-        baseline["gebjaar"] = baseline["gebdat"].astype("datetime64[ns]").dt.year
-    baseline["Age"] = (
-        baseline["start_date"].astype("datetime64[ns]").dt.year - baseline["gebjaar"]
-    )
+        baseline["gebjaar"] = baseline["gebdat"].dt.year
+    baseline["Age"] = baseline["start_date"].dt.year - baseline["gebjaar"]
 
     return baseline
 
 
+def build_cohorts(dataset, funnel=None, backend="pandas", rest=None):
+    # features shared by the definite and possible cohorts are computed once on the full dataset.
+    # rest reads all columns of the given rows of the input, for the columns that were not read
+    # up front
+    dataset["start_date"] = find_start_date(dataset)
+    if backend == "polars":
+        prepared = polars_backend.prepare(dataset)
+    else:
+        episodes = find_episodes(dataset)
+    last_contact = dataset[~dataset["datlcont"].isna()].groupby("upn").datlcont.max()
+
+    cohorts = {}
+    for cohort in ["included", "possible"]:
+        with profiling.stage("select", len(dataset), cohort=cohort) as record:
+            if backend == "polars":
+                selected, steps = polars_backend.select(dataset, prepared, cohort)
+                if cohort == "included":
+                    for step, patients in steps:
+                        report_excluded(step, patients, funnel)
+            elif cohort == "included":
+                selected = select(dataset, episodes, funnel)
+            else:
+                selected = select_possible(dataset, episodes)
+            record["rows_out"] = len(selected)
+
+        with profiling.stage("baseline", len(selected), cohort=cohort) as record:
+            baseline = find_baseline_entry(selected)
+            record["rows_out"] = len(baseline)
+
+        with profiling.stage("endpoints", len(baseline), cohort=cohort) as record:
+            baseline = add_endpoints(baseline, selected)
+            record["rows_out"] = len(baseline)
+
+        cohorts[cohort] = (baseline, selected)
+
+    # the other columns are read once for the baseline entries of both cohorts
+    if rest is not None:
+        with profiling.stage("passthrough") as record:
+            rows = {
+                cohort: baseline_rows(selected)
+                for cohort, (_, selected) in cohorts.items()
+            }
+            columns = rest(rows["included"].index.union(rows["possible"].index))
+            record["rows_out"] = len(columns)
+        for cohort, (baseline, selected) in cohorts.items():
+            cohorts[cohort] = (add_columns(baseline, rows[cohort], columns), selected)
+
+    for cohort, (baseline, selected) in cohorts.items():
+        with profiling.stage("preprocess", len(baseline), cohort=cohort) as record:
+            baseline = preprocess(baseline, selected, last_contact)
+            record["rows_out"] = len(baseline)
+        cohorts[cohort] = baseline
+
+    return cohorts["included"], cohorts["possible"]
+
+
+def write_cohorts(baseline, possible_baseline, config, name, append=False):
+    output_folder = Path(config["intermediate_output_folder"])
+    with profiling.stage("write", len(baseline) + len(possible_baseline)):
+        for cohort, fp in [
+            (baseline, output_folder / (name + ".csv")),
+            (possible_baseline, output_folder / (name + "_possible.csv")),
+        ]:
+            cohort.to_csv(fp, mode="a" if append else "w", header=not append)
+
+
+def process_center_in_buckets(dataset_fp, config, buckets, backend="pandas"):
+    # every selection and endpoint rule only looks at the rows of a single patient, so the
+    # patients can be split over buckets that are processed one at a time, and the memory use is
+    # bounded by the size of a bucket instead of the size of the file
+    name = config["names"][dataset_fp.name]
+    passthrough = config.get("passthrough_columns")
+    included = possible = 0
+    funnel = {}
+    with tempfile.TemporaryDirectory(
+        dir=config["intermediate_output_folder"]
+    ) as folder:
+        # the buckets keep every column when the other columns are read for the baseline entries
+        with profiling.stage("partition") as record:
+            bucket_fps, dtype = schema.partition(
+                dataset_fp,
+                folder,
+                buckets,
+                "all" if passthrough is None else passthrough,
+            )
+            record["rows_out"] = len(bucket_fps)
+
+        print("#" * 100)
+        print("Processing dataset {} ...".format(dataset_fp.name))
+
+        for i, bucket_fp in enumerate(bucket_fps):
+            with profiling.stage("load") as record:
+                dataset = schema.read(
+                    bucket_fp,
+                    passthrough,
+                    config.get("date_format") or schema.DATE_FORMAT,
+                    dtype=dtype,
+                )
+                record["rows_out"] = len(dataset)
+
+            rest = None
+            if passthrough is None:
+                rest = partial(schema.read_rows, bucket_fp, dtype=dtype)
+            baseline, possible_baseline = build_cohorts(dataset, funnel, backend, rest)
+            write_cohorts(baseline, possible_baseline, config, name, append=i > 0)
+            included += len(baseline)
+            possible += len(possible_baseline)
+
+    for step, patients in funnel.items():
+        report_excluded(step, patients)
+
+    return {"included": included, "possible": possible}
+
+
+def process_changed_patients(dataset, config, name, update, backend="pandas"):
+    # only the patients that were added or changed since the previous run are processed, and the
+    # previous outputs are updated for them. When there is no previous run to update, all patients
+    # are processed and the hashes are recorded for the next run.
+    output_folder = Path(config["intermediate_output_folder"])
+    outputs = [
+        output_folder / (name + ".csv"),
+        output_folder / (name + "_possible.csv"),
+    ]
+    with profiling.stage("hash", len(dataset)) as record:
+        hashes = delta.patient_hashes(dataset)
+        previous = delta.load(output_folder, name, outputs) if update else None
+        record["rows_out"] = len(hashes)
+
+    if previous is not None:
+        changes = delta.diff(previous, hashes)
+        delta.write_changes(output_folder, name, changes)
+        for change in ["added", "removed", "changed"]:
+            print("Patients {}: {}".format(change, (changes == change).sum()))
+
+        changed = dataset[dataset["upn"].isin(changes.index)]
+        if len(changed):
+            baseline, possible_baseline = build_cohorts(changed, backend=backend)
+        else:
+            baseline = possible_baseline = pd.DataFrame()
+
+        # when a column was added to or removed from the extract, the previous outputs have other
+        # columns than the recomputed rows, and are written again for all patients
+        if not delta.same_columns(outputs, [baseline, possible_baseline]):
+            print("The columns of the outputs changed, all patients are processed")
+            previous = None
+
+    if previous is None:
+        baseline, possible_baseline = build_cohorts(dataset, backend=backend)
+        write_cohorts(baseline, possible_baseline, config, name)
+        summary = {"included": len(baseline), "possible": len(possible_baseline)}
+    else:
+        with profiling.stage("write", len(baseline) + len(possible_baseline)):
+            summary = {
+                cohort: delta.update_output(fp, df, changes.index)
+                for cohort, fp, df in zip(
+                    ["included", "possible"], outputs, [baseline, possible_baseline]
+                )
+            }
+
+    delta.save(output_folder, name, hashes, outputs)
+    return summary
+
+
+def passthrough_columns(dataset_fp, config, changed_only=False):
+    # without passthrough_columns in the config every column ends up in the output. For csv files
+    # the columns outside the schema are then only read for the baseline entries, other files are
+    # parsed as a whole anyway. --delta hashes every column that ends up in the output.
+    passthrough = config.get("passthrough_columns")
+    if passthrough is None and (changed_only or dataset_fp.suffix != ".csv"):
+        return "all"
+    return passthrough
+
+
+def process_center(
+    dataset_fp,
+    config,
+    cache_options,
+    buckets=1,
+    changed_only=False,
+    update=False,
+    backend="pandas",
+):
+    if buckets > 1 and dataset_fp.suffix == ".csv":
+        return process_center_in_buckets(dataset_fp, config, buckets, backend)
+
+    passthrough = passthrough_columns(dataset_fp, config, changed_only)
+    with profiling.stage("load") as record:
+        dataset = schema.read(
+            dataset_fp,
+            passthrough,
+            config.get("date_format") or schema.DATE_FORMAT,
+            cache_options,
+        )
+        record["rows_out"] = len(dataset)
+
+    print("#" * 100)
+    print("Processing dataset {} ...".format(dataset_fp.name))
+    name = config["names"][dataset_fp.name]
+
+    if changed_only:
+        return process_changed_patients(dataset, config, name, update, backend)
+
+    rest = None
+    if passthrough is None:
+        rest = partial(schema.read_rows, dataset_fp)
+    baseline, possible_baseline = build_cohorts(dataset, backend=backend, rest=rest)
+    write_cohorts(baseline, possible_baseline, config, name)
+
+    return {"included": len(baseline), "possible": len(possible_baseline)}
+
+
+def run_center(
+    dataset_fp,
+    config,
+    cache_options,
+    buckets=1,
+    profile=False,
+    changed_only=False,
+    update=False,
+    backend="pandas",
+):
+    # run a single center with its output captured, so that a failing center does not stop the others
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log), profiling.profile(
+        profile, center=dataset_fp.name
+    ) as report:
+        try:
+            summary = {
+                "status": "ok",
+                **process_center(
+                    dataset_fp,
+                    config,
+                    cache_options,
+                    buckets,
+                    changed_only,
+                    update,
+                    backend,
+                ),
+            }
+        except Exception:
+            traceback.print_exc(file=log)
+            summary = {"status": "failed"}
+    summary["seconds"] = round(time.perf_counter() - start, 1)
+
+    return log.getvalue(), {"center": dataset_fp.name, **summary}, report
+
+
+def center_outputs(dataset_fp, config):
+    name = config["names"].get(dataset_fp.name)
+    if name is None:
+        return None
+    output_folder = Path(config["intermediate_output_folder"])
+    return [output_folder / (name + ".csv"), output_folder / (name + "_possible.csv")]
+
+
+def center_record(dataset_fp, config):
+    return manifest.record(
+        {"dataset": dataset_fp},
+        {
+            "name": config["names"].get(dataset_fp.name),
+            "passthrough_columns": config.get("passthrough_columns"),
+            "date_format": config.get("date_format"),
+        },
+        manifest.code_version(
+            __file__,
+            rules.__file__,
+            schema.__file__,
+            polars_backend.__file__,
+            delta.__file__,
+        ),
+    )
+
+
+def run_centers(
+    dataset_fps,
+    config,
+    cache_options,
+    workers=1,
+    incremental=False,
+    buckets=1,
+    profile=False,
+    changed_only=False,
+    backend="pandas",
+):
+    output_folder = Path(config["intermediate_output_folder"])
+    runs = manifest.load(output_folder)
+    records = {fp.name: center_record(fp, config) for fp in dataset_fps}
+
+    # in incremental mode, only centers whose input, config or code changed since the last run are processed
+    summary = {}
+    stale = []
+    for fp in dataset_fps:
+        outputs = center_outputs(fp, config)
+        if (
+            incremental
+            and outputs is not None
+            and manifest.is_up_to_date(
+                runs, "01_preprocess", fp.name, records[fp.name], outputs
+            )
+        ):
+            summary[fp.name] = {"center": fp.name, "status": "up to date"}
+        else:
+            stale.append(fp)
+
+    # outputs can only be updated for the changed patients when the code and config are the same as
+    # in the run that wrote them
+    previous = runs.get("01_preprocess", {})
+    update = [
+        fp.name in previous
+        and previous[fp.name]["code"] == records[fp.name]["code"]
+        and previous[fp.name]["config"] == records[fp.name]["config"]
+        for fp in stale
+    ]
+
+    # logs are emitted in the order of the input files, regardless of which center finishes first
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    results = (pool.map if pool else map)(
+        run_center,
+        stale,
+        repeat(config),
+        repeat(cache_options),
+        repeat(buckets),
+        repeat(profile),
+        repeat(changed_only),
+        update,
+        repeat(backend),
+    )
+
+    reports = []
+    for log, center_summary, report in results:
+        print(log, end="")
+        if report is not None:
+            report["status"] = center_summary["status"]
+            profiling.write(
+                report,
+                output_folder,
+                "01_preprocess/" + Path(center_summary["center"]).stem,
+            )
+            reports.append(report)
+        center = center_summary["center"]
+        summary[center] = center_summary
+        if center_summary["status"] == "ok":
+            manifest.update(runs, "01_preprocess", center, records[center])
+            manifest.save(output_folder, runs)
+
+    if pool:
+        pool.shutdown()
+
+    summary = pd.DataFrame([summary[fp.name] for fp in dataset_fps]).convert_dtypes()
+    print("#" * 100)
+    print(summary.to_string(index=False))
+
+    if profile:
+        profiling.summarize(reports, output_folder, "01_preprocess/summary")
+
+    return summary
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument("config_name")
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of centers to process in parallel",
+)
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="always parse the input files instead of reusing the cached result of an earlier run",
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="only process centers whose input file, config or code changed since the last run",
+)
+parser.add_argument(
+    "--buckets",
+    type=int,
+    default=1,
+    help="stream csv files in chunks and process the patients in this many buckets, to limit memory use",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="record the time, memory and row counts of every stage in a json report per center",
+)
+parser.add_argument(
+    "--backend",
+    choices=["pandas", "polars"],
+    default="pandas",
+    help="library the cohorts are selected with, polars needs the polars package",
+)
+parser.add_argument(
+    "--delta",
+    action="store_true",
+    help="only process the patients that were added or changed since the last --delta run, and update the outputs for them",
+)
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    if args.delta and args.buckets > 1:
+        parser.error("--delta cannot be combined with --buckets")
 
     with open(f"../config/{args.config_name}") as f:
         config = yaml.safe_load(f)
@@ -377,26 +837,16 @@ if __name__ == "__main__":
     # ) as f:
     #     config = yaml.safe_load(f)
 
-    for dataset_fp in Path(config["input_folder"]).iterdir():
-        if dataset_fp.name.endswith(".xlsx"):
-            dataset = pd.read_excel(dataset_fp)
-        else:
-            dataset = pd.read_csv(dataset_fp)
-
-        print("#" * 100)
-        print("Processing dataset {} ...".format(dataset_fp.name))
-        name = config["names"][dataset_fp.name]
-
-        dataset["upn"] = dataset["upn"].astype(str)
-
-        selected = select(dataset)
-        baseline = find_baseline_entry(selected)
-        baseline = preprocess(baseline, selected, dataset)
-        baseline.to_csv(Path(config["intermediate_output_folder"]) / (name + ".csv"))
-
-        possible = select_possible(dataset)
-        possible_baseline = find_baseline_entry(possible)
-        possible_baseline = preprocess(possible_baseline, possible, dataset)
-        possible_baseline.to_csv(
-            Path(config["intermediate_output_folder"]) / (name + "_possible.csv")
-        )
+    summary = run_centers(
+        list(Path(config["input_folder"]).iterdir()),
+        config,
+        cache.options_from_config(config, args.no_cache),
+        workers=args.workers,
+        incremental=args.incremental,
+        buckets=args.buckets,
+        profile=args.profile,
+        changed_only=args.delta,
+        backend=args.backend,
+    )
+    if (summary["status"] == "failed").any():
+        sys.exit(1)
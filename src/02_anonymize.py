@@ -5,43 +5,52 @@ import pandas as pd
 from pathlib import Path
 import warnings
 
+import manifest
+import profiling
 
 warnings.filterwarnings("ignore")
 
+# corrections that are applied to the original extract when the config does not list any
+DEFAULT_CORRECTIONS = "../config/corrections_original.csv"
 
-parser = argparse.ArgumentParser()
-parser.add_argument("config_name")
-args = parser.parse_args()
-with open(f"../config/{args.config_name}") as f:
-    config = yaml.safe_load(f)
-# with open(
-#     f"V:\Medische-oncologie\OncologieOnderzoek\Melanoom\PREMIUM\premium_selection\config\config_updated.yaml"
-# ) as f:
-#     config = yaml.safe_load(f)
 
+def normalize_upn(upn):
+    # upns are matched as text in one form, whatever dtype they were read with: whole numbers that
+    # were read or written as floats (e.g. because some upns are missing) lose their trailing .0,
+    # and numbers lose their leading zeros, like when they are read back as numbers
+    if pd.api.types.is_float_dtype(upn):
+        whole = upn.notna() & (upn % 1 == 0)
+        text = upn.astype("string")
+        text[whole] = upn[whole].astype("int64").astype("string")
+    else:
+        text = upn.astype("string")
+    return text.str.replace(r"^0*(\d+?)(\.0*)?$", r"\1", regex=True)
 
-datasets = [
-    ds.name
-    for ds in Path(config["intermediate_output_folder"]).iterdir()
-    if not "possible" in ds.name
-]
 
-coding = pd.read_csv(config["upn_to_study_coding"]).set_index("upn")
-already_encoded = config["already_encoded"]
+def load_coding(fp):
+    coding = pd.read_csv(fp, dtype={"upn": str})
+    coding["upn"] = normalize_upn(coding["upn"])
+    return coding.drop_duplicates("upn").set_index("upn")["premium_id"]
 
 
-# loop through the preprocessed dataframe of every center
-stack = []
-for fp in datasets:
-    print("#" * 100)
-    print("Processing dataset {}\n".format(fp))
-
-    # combine datasets of automatically and manually included patients
+def load_center(fp, config):
     dataset = pd.read_csv(Path(config["intermediate_output_folder"]) / fp)
     possible = pd.read_csv(
         Path(config["intermediate_output_folder"]) / (fp[:-4] + "_possible.csv")
     )
-    to_add = possible[possible.upn.isin(config["include_with_other_therapy"][fp])]
+    return dataset, possible
+
+
+def anonymize_center(fp, config, coding, dataset, possible):
+    print("#" * 100)
+    print("Processing dataset {}\n".format(fp))
+
+    # combine datasets of automatically and manually included patients
+    to_add = possible[
+        normalize_upn(possible.upn).isin(
+            normalize_upn(pd.Series(config["include_with_other_therapy"][fp]))
+        )
+    ]
     print(
         "Adding {} entries manually.\n".format(
             len(config["include_with_other_therapy"][fp])
@@ -52,28 +61,20 @@ for fp in datasets:
     dataset["center"] = [fp[:-4]] * len(dataset)
 
     # check if patient ids have already been encoded
-    if fp in already_encoded:
-        # if yes, format the ids to have only _ instead of -
-        dataset["id"] = [
-            code.replace("-", "_") if type(code) == str and not pd.isna(code) else code
-            for code in dataset.upn
-        ]
+    if fp in config["already_encoded"]:
+        # if yes, format the ids to have only _ instead of -. Values that are not text are kept as they are,
+        # upns kept as text in memory are formatted the same as those read back from the csv files
+        if pd.api.types.is_numeric_dtype(dataset.upn):
+            dataset["id"] = dataset.upn
+        else:
+            upn = dataset.upn.astype(object)
+            dataset["id"] = upn.str.replace("-", "_", regex=False).fillna(upn)
 
     else:
         # if no, find the corresponding code for every patient from the coding csv
-        codes = []
-        missing = []
-        for upn in dataset.upn:
-            try:
-                codes.append(
-                    coding.loc[
-                        str(int(upn)) if type(upn) == float else upn, "premium_id"
-                    ]
-                )
-            except:
-                codes.append(float("nan"))
-                missing.append(upn)
-        dataset["id"] = codes
+        upn = normalize_upn(dataset.upn)
+        dataset["id"] = upn.map(coding).astype(object).fillna(float("nan")).to_numpy()
+        missing = dataset.upn[~upn.isin(coding.index)].tolist()
 
         print("No IDs are supplied for the following upns: \n{}\n".format(str(missing)))
 
@@ -86,71 +87,265 @@ for fp in datasets:
         if col in dataset.columns:
             dataset = dataset.drop(columns=[col])
 
-    stack.append(dataset)
-
-# combine dataframes of all centers
-dmtr = pd.concat(stack)
-dmtr["age"] = dmtr["start_date"].astype("datetime64[ns]").dt.year - dmtr["gebjaar"]
-dmtr = dmtr.replace({"geslacht": {1: "Male", 2: "Female"}})
-dmtr = dmtr[~(dmtr.id == "?????? Geen nummer ")]
-dmtr = dmtr[~dmtr.id.isna()].set_index("id")
-
-# fill some missing values for age and therapy
-if "original" in args.config_name:
-    dmtr.loc["PREM_LU_109", "Age"] = 68
-    dmtr.loc["PREM_LU_212", "Age"] = 63
-    dmtr.loc["PREM_LU_413", "Age"] = 62
-    dmtr.loc["PREM_RA_232", "Age"] = 25
-    dmtr.loc["PREM_RA_235", "Age"] = 51
-    dmtr.loc["PREM_UMCU_010", "Age"] = 78
-    dmtr.loc["PREM_UMCU_029", "Age"] = 89
-    dmtr.loc["PREM_VU_178", "Age"] = 56
-    dmtr.loc["PREM_VU_178", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_AM_004", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_AM_054", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_AM_067", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AM_123", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_IS_140", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_IS_141", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_IS_142", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_RA_105", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["IM_102", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["IM_248", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["IM_206", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_VU_186", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_VU_187", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_VU_188", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_VU_189", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_VU_190", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_VU_191", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_IS_143", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_LU_492", "Therapy"] = "Anti-PD1"
-    dmtr.loc["MAX_199", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_UMCU_040", "Therapy"] = "Anti-PD1"
-    dmtr.loc["PREM_AVL_578", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_579", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_581", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_583", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_584", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_586", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_588", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_591", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_593", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_595", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_596", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_597", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_598", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_599", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_600", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_603", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_604", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_605", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_606", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_607", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_609", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_611", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_612", "Therapy"] = "Ipilimumab & Nivolumab"
-    dmtr.loc["PREM_AVL_629", "Therapy"] = "Anti-PD1"
-
-# save final file
-dmtr.to_csv(config["output_file"])
+    return dataset
+
+
+def center_record(fp, config):
+    folder = Path(config["intermediate_output_folder"])
+    already_encoded = fp in config["already_encoded"]
+    return manifest.record(
+        {
+            "dataset": folder / fp,
+            "possible": folder / (fp[:-4] + "_possible.csv"),
+            "coding": None if already_encoded else config["upn_to_study_coding"],
+        },
+        {
+            "include_with_other_therapy": config["include_with_other_therapy"][fp],
+            "already_encoded": already_encoded,
+        },
+        manifest.code_version(__file__),
+    )
+
+
+def anonymize_centers(datasets, config, incremental=False, profile=False):
+    # the anonymized dataframe of every center is kept between runs, so that in incremental mode
+    # only the centers whose input, config or code changed since the last run are rebuilt
+    folder = Path(config["intermediate_output_folder"])
+    runs = manifest.load(folder)
+    coding = None
+
+    blocks = []
+    reports = []
+    for fp in datasets:
+        record = center_record(fp, config)
+        block = folder / "anonymized" / (fp[:-4] + ".pkl")
+        if incremental and manifest.is_up_to_date(
+            runs, "02_anonymize", fp, record, [block]
+        ):
+            print("#" * 100)
+            print("Dataset {} is up to date\n".format(fp))
+            blocks.append(block)
+            continue
+
+        with profiling.profile(profile, center=fp) as report:
+            with profiling.stage("load") as stage:
+                if coding is None:
+                    coding = load_coding(config["upn_to_study_coding"])
+                dataset, possible = load_center(fp, config)
+                stage["rows_out"] = len(dataset) + len(possible)
+
+            with profiling.stage("anonymize", len(dataset) + len(possible)) as stage:
+                dataset = anonymize_center(fp, config, coding, dataset, possible)
+                stage["rows_out"] = len(dataset)
+
+            with profiling.stage("write", len(dataset)):
+                block.parent.mkdir(exist_ok=True)
+                dataset.to_pickle(block)
+
+        if report is not None:
+            profiling.write(report, folder, "02_anonymize/" + fp[:-4])
+            reports.append(report)
+        manifest.update(runs, "02_anonymize", fp, record)
+        manifest.save(folder, runs)
+
+        blocks.append(block)
+
+    return blocks, reports
+
+
+def finalize_center(dataset):
+    # the steps on the final dataframe only look at single rows, so they can be applied per center
+    dataset["age"] = (
+        dataset["start_date"].astype("datetime64[ns]").dt.year - dataset["gebjaar"]
+    )
+    dataset = dataset.replace({"geslacht": {1: "Male", 2: "Female"}})
+    dataset = dataset[~(dataset.id == "?????? Geen nummer ")]
+    return dataset[~dataset.id.isna()].set_index("id")
+
+
+def combine_centers(stack):
+    return finalize_center(pd.concat(stack))
+
+
+def _is_number(dtype):
+    return (
+        isinstance(dtype, np.dtype)
+        and pd.api.types.is_numeric_dtype(dtype)
+        and not pd.api.types.is_bool_dtype(dtype)
+    )
+
+
+def output_columns(blocks):
+    # the columns of the combined dataframe, in the order pd.concat would give them, and the dtype
+    # pd.concat would give the numeric columns: a column that is int in one center and float or
+    # missing in another is float in every center. Centers without rows do not change a dtype.
+    columns = pd.Index([])
+    dtypes = {}
+    centers = 0
+    for block in blocks:
+        dataset = pd.read_pickle(block)
+        columns = columns.union(dataset.columns, sort=False)
+        dataset = finalize_center(dataset)
+        if len(dataset):
+            centers += 1
+            for col, dtype in dataset.dtypes.items():
+                dtypes.setdefault(col, []).append(dtype)
+
+    columns = columns.drop("id", errors="ignore")
+    if "age" not in columns:
+        columns = columns.append(pd.Index(["age"]))
+
+    numeric = {}
+    for col, found in dtypes.items():
+        if len(found) < centers:
+            found.append(np.dtype("float64"))
+        if all(_is_number(dtype) for dtype in found):
+            numeric[col] = np.result_type(*found)
+    return columns, numeric
+
+
+def write_centers(blocks, output_file, corrections=None):
+    # every center is finalized and appended to the output file in turn, so that only one center
+    # is in memory at a time
+    columns, dtypes = output_columns(blocks)
+    ids = []
+    changed = 0
+    rows = 0
+    for i, block in enumerate(blocks):
+        dataset = finalize_center(pd.read_pickle(block))
+        if corrections is not None:
+            changed += correct(dataset, corrections)
+        # corrections may widen a dtype further, e.g. a float value in an int column
+        dataset = dataset.astype(
+            {
+                col: np.result_type(dtype, dataset[col].dtype)
+                for col, dtype in dtypes.items()
+                if col in dataset.columns and _is_number(dataset[col].dtype)
+            }
+        )
+        dataset.reindex(columns=columns).to_csv(
+            output_file, mode="a" if i else "w", header=i == 0
+        )
+        ids.extend(dataset.index)
+        rows += len(dataset)
+
+    if not blocks:
+        pd.DataFrame(columns=columns, index=pd.Index([], name="id")).to_csv(output_file)
+    if corrections is not None:
+        report_corrections(corrections, ids, columns, changed)
+    return rows
+
+
+def find_corrections(config, config_name):
+    corrections = config.get("corrections")
+    if corrections is None and "original" in config_name:
+        return DEFAULT_CORRECTIONS
+    return corrections
+
+
+def load_corrections(corrections):
+    # corrections is a csv file with an id, column and value column, or the same rows as a list in the config
+    if isinstance(corrections, str):
+        return pd.read_csv(corrections, dtype=str)
+    return pd.DataFrame(corrections, columns=["id", "column", "value"])
+
+
+def correct(dmtr, corrections):
+    # every column is corrected in one assignment, corrections for ids or columns that are not in
+    # dmtr are skipped. Returns the number of values that changed.
+    changed = 0
+    for column, rows in corrections.groupby("column", sort=False):
+        if column not in dmtr.columns:
+            continue
+        values = rows.drop_duplicates("id", keep="last").set_index("id")["value"]
+        if pd.api.types.is_numeric_dtype(dmtr[column]):
+            values = pd.to_numeric(values)
+
+        new = pd.Series(dmtr.index.map(values), index=dmtr.index)
+        corrected = dmtr.index.isin(values.index)
+        old = dmtr.loc[corrected, column]
+        changed += (
+            ~((old == new[corrected]) | (old.isna() & new[corrected].isna()))
+        ).sum()
+        dmtr.loc[corrected, column] = new[corrected]
+    return changed
+
+
+def report_corrections(corrections, ids, columns, changed):
+    unknown_ids = corrections.loc[~corrections["id"].isin(ids), "id"]
+    unknown_columns = corrections.loc[~corrections["column"].isin(columns), "column"]
+    if len(unknown_ids):
+        print(
+            "Corrections for unknown ids: \n{}\n".format(unknown_ids.unique().tolist())
+        )
+    if len(unknown_columns):
+        print(
+            "Corrections for unknown columns: \n{}\n".format(
+                unknown_columns.unique().tolist()
+            )
+        )
+    print("Corrected {} values.\n".format(changed))
+
+
+def apply_corrections(dmtr, corrections):
+    changed = correct(dmtr, corrections)
+    report_corrections(corrections, dmtr.index, dmtr.columns, changed)
+    return dmtr
+
+
+def run(config, config_name, incremental=False, profile=False):
+    datasets = [
+        ds.name
+        for ds in Path(config["intermediate_output_folder"]).iterdir()
+        if ds.suffix == ".csv" and not "possible" in ds.name
+    ]
+
+    # loop through the preprocessed dataframe of every center
+    blocks, reports = anonymize_centers(
+        datasets, config, incremental=incremental, profile=profile
+    )
+
+    # the steps on the combined dataframe are profiled as a center of their own
+    if profile:
+        profiling.start(center="all")
+
+    # combine the dataframes of all centers into the final file, and fill some missing values for
+    # age and therapy
+    corrections = find_corrections(config, config_name)
+    with profiling.stage("combine") as stage:
+        stage["rows_out"] = write_centers(
+            blocks,
+            config["output_file"],
+            load_corrections(corrections) if corrections else None,
+        )
+
+    if profile:
+        reports.append(profiling.stop())
+        profiling.summarize(
+            reports, config["intermediate_output_folder"], "02_anonymize/summary"
+        )
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("config_name")
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="only rebuild centers whose input, config or code changed since the last run",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="record the time, memory and row counts of every stage in a json report per center",
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with open(f"../config/{args.config_name}") as f:
+        config = yaml.safe_load(f)
+    # with open(
+    #     f"V:\Medische-oncologie\OncologieOnderzoek\Melanoom\PREMIUM\premium_selection\config\config_updated.yaml"
+    # ) as f:
+    #     config = yaml.safe_load(f)
+
+    run(config, args.config_name, incremental=args.incremental, profile=args.profile)
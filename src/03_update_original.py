@@ -1,94 +1,169 @@
+import argparse
 import yaml
 import pandas as pd
+from pathlib import Path
 
-with open(f"../config/config_updated.yaml") as f:
-    config_updated = yaml.safe_load(f)
+import linkage
+import profiling
 
-updated_dmtr = pd.read_csv(config_updated["output_file"]).set_index("id")
+endpoints = [
+    "fu_OS",
+    "event_OS",
+    "fu_PFS",
+    "event_PFS",
+    "dcb",
+    "orr",
+    "Best overall response",
+]
 
-with open(f"../config/config_original.yaml") as f:
-    config_original = yaml.safe_load(f)
 
-original_dmtr = pd.read_csv(config_original["output_file"]).set_index("id")
+def match(original_dmtr, updated_dmtr, tolerance_days=linkage.TOLERANCE_DAYS):
+    matched_step1 = original_dmtr.join(
+        updated_dmtr, lsuffix="_original", rsuffix="_updated", how="inner"
+    )
+    matched_step1["id_updated"] = matched_step1.index
+    matched_step1["match_score"] = 1.0
+
+    unmatched_original = original_dmtr[
+        ~original_dmtr.index.isin(matched_step1.index.tolist())
+    ]
+    unmatched_updated = updated_dmtr[
+        ~updated_dmtr.index.isin(matched_step1.index.tolist())
+    ]
+
+    # patients that were renumbered are linked on their center, birth year and dates
+    links = linkage.link(
+        unmatched_original, unmatched_updated, tolerance_days=tolerance_days
+    )
+    matched_step2 = (
+        unmatched_original.iloc[links["row_original"]]
+        .reset_index()
+        .join(
+            unmatched_updated.iloc[links["row_updated"]].reset_index(drop=True),
+            lsuffix="_original",
+            rsuffix="_updated",
+        )
+        .assign(id_updated=links["id_updated"], match_score=links["score"])
+        .set_index("id")
+    )
 
-matched_step1 = original_dmtr.join(
-    updated_dmtr, lsuffix="_original", rsuffix="_updated", how="inner"
-)
+    return pd.concat([matched_step1, matched_step2])
 
-unmatched_original = original_dmtr[
-    ~original_dmtr.index.isin(matched_step1.index.tolist())
-]
-unmatched_updated = updated_dmtr[~updated_dmtr.index.isin(matched_step1.index.tolist())]
 
-unmatched_original = unmatched_original[unmatched_original.center.isin(["lumc", "mst"])]
+def merge_endpoints(original_dmtr, all_matched, missing_patient_level_labels):
+    merged_dmtr = original_dmtr.join(
+        all_matched[[f"{p}_updated" for p in endpoints]], how="outer"
+    )
+
+    # the manual labels only fill the dcb and response that are missing in the original dmtr
+    labels = missing_patient_level_labels[["dcb", "response"]].rename(
+        columns={"response": "orr"}
+    )
+    merged_dmtr[["dcb", "orr"]] = merged_dmtr[["dcb", "orr"]].fillna(
+        labels.reindex(merged_dmtr.index)
+    )
+
+    # the updated endpoints take precedence over both where they are known
+    for endpoint in endpoints:
+        merged_dmtr[endpoint] = merged_dmtr[f"{endpoint}_updated"].fillna(
+            merged_dmtr[endpoint]
+        )
 
-key = ["gebjaar", "datprim", "start_date"]
+    merged_dmtr = merged_dmtr.drop(columns=[f"{p}_updated" for p in endpoints])
 
-matched_step2 = (
-    unmatched_original.reset_index()
-    .set_index(key)
-    .join(
-        unmatched_original.set_index(key),
-        lsuffix="_original",
-        rsuffix="_updated",
-        how="inner",
+    return merged_dmtr
+
+
+# the manual labels and the output of the update, unless other files are given
+LABELS_FILE = r"C:\Users\user\data\tables\missing_patient_level_labels.csv"
+OUTPUT_FILE = "V:\Medische-oncologie\OncologieOnderzoek\Melanoom\PREMIUM\premium_selection\data\dmtr.csv"
+
+
+def matches_path(config_updated):
+    # the match table, to check the patients that were matched on their dates. It is kept out of
+    # the intermediate_output_folder itself, where 02_anonymize.py takes every csv file for a center
+    return (
+        Path(config_updated["intermediate_output_folder"])
+        / "03_update_original"
+        / "matches.csv"
     )
-    .set_index("id")
+
+
+def update_original(
+    config_updated,
+    config_original,
+    labels_fp=LABELS_FILE,
+    output_fp=OUTPUT_FILE,
+    tolerance_days=linkage.TOLERANCE_DAYS,
+    profile=False,
+):
+    if profile:
+        profiling.start(center="all")
+
+    with profiling.stage("load") as record:
+        updated_dmtr = pd.read_csv(config_updated["output_file"]).set_index("id")
+        original_dmtr = pd.read_csv(config_original["output_file"]).set_index("id")
+        missing_patient_level_labels = pd.read_csv(labels_fp, sep=";").set_index(
+            "patient"
+        )
+        record["rows_out"] = len(updated_dmtr) + len(original_dmtr)
+
+    with profiling.stage("match", len(updated_dmtr) + len(original_dmtr)) as record:
+        all_matched = match(original_dmtr, updated_dmtr, tolerance_days)
+        record["rows_out"] = len(all_matched)
+
+    matches_fp = matches_path(config_updated)
+    matches_fp.parent.mkdir(exist_ok=True)
+    all_matched[["id_updated", "match_score"]].to_csv(matches_fp)
+
+    with profiling.stage("merge", len(original_dmtr)) as record:
+        merged_dmtr = merge_endpoints(
+            original_dmtr, all_matched, missing_patient_level_labels
+        )
+        record["rows_out"] = len(merged_dmtr)
+
+    with profiling.stage("write", len(merged_dmtr)):
+        merged_dmtr.to_csv(output_fp)
+
+    if profile:
+        report = profiling.stop()
+        profiling.write(
+            report,
+            config_updated["intermediate_output_folder"],
+            "03_update_original/all",
+        )
+        profiling.summarize(
+            [report],
+            config_updated["intermediate_output_folder"],
+            "03_update_original/summary",
+        )
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="record the time, memory and row counts of every stage in a json report",
+)
+parser.add_argument(
+    "--tolerance-days",
+    type=int,
+    default=linkage.TOLERANCE_DAYS,
+    help="how many days the dates of a renumbered patient may differ between the exports",
 )
 
-all_matched = pd.concat([matched_step1, matched_step2])
+if __name__ == "__main__":
+    args = parser.parse_args()
 
-endpoints = [
-    "fu_OS",
-    "event_OS",
-    "fu_PFS",
-    "event_PFS",
-    "dcb",
-    "orr",
-    "Best overall response",
-]
+    with open(f"../config/config_updated.yaml") as f:
+        config_updated = yaml.safe_load(f)
 
-merged_dmtr = original_dmtr.join(
-    all_matched[[f"{p}_updated" for p in endpoints]], how="outer"
-)
+    with open(f"../config/config_original.yaml") as f:
+        config_original = yaml.safe_load(f)
 
-missing_patient_level_labels = pd.read_csv(
-    r"C:\Users\user\data\tables\missing_patient_level_labels.csv", sep=";"
-).set_index("patient")
-
-dcb = []
-response = []
-for ix, row in merged_dmtr.iterrows():
-    if pd.isna(row.dcb):
-        if ix in missing_patient_level_labels.index:
-            dcb.append(missing_patient_level_labels.loc[ix, "dcb"])
-        else:
-            dcb.append(float("nan"))
-    else:
-        dcb.append(row.dcb)
-
-    if pd.isna(row.orr):
-        if ix in missing_patient_level_labels.index:
-            response.append(missing_patient_level_labels.loc[ix, "response"])
-        else:
-            response.append(float("nan"))
-    else:
-        response.append(row.orr)
-
-merged_dmtr["dcb"] = dcb
-merged_dmtr["orr"] = response
-
-for endpoint in endpoints:
-    values = []
-    for ix, row in merged_dmtr.iterrows():
-        if pd.isna(row[f"{endpoint}_updated"]):
-            values.append(row[endpoint])
-        else:
-            values.append(row[f"{endpoint}_updated"])
-    merged_dmtr[endpoint] = values
-
-merged_dmtr = merged_dmtr.drop(columns=[f"{p}_updated" for p in endpoints])
-
-merged_dmtr.to_csv(
-    "V:\Medische-oncologie\OncologieOnderzoek\Melanoom\PREMIUM\premium_selection\data\dmtr.csv"
-)
+    update_original(
+        config_updated,
+        config_original,
+        tolerance_days=args.tolerance_days,
+        profile=args.profile,
+    )
@@ -0,0 +1,325 @@
+import argparse
+import contextlib
+import datetime
+import importlib
+import importlib.util
+import io
+import json
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import schema
+import synthetic
+
+preprocessing = importlib.import_module("01_preprocess")
+anonymization = importlib.import_module("02_anonymize")
+update = importlib.import_module("03_update_original")
+
+CENTERS = ["lumc", "mst", "center_a", "center_b"]
+
+
+def measure(stage, func, *args, repeat=1):
+    # wall time is the best of `repeat` runs, peak memory is measured in a separate traced run
+    # because tracing slows down the allocation-heavy stages
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func(*args)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        "stage": stage,
+        "seconds": round(min(seconds), 4),
+        "peak_mb": round(peak / 1024**2, 2),
+    }
+
+
+def copies(*frames):
+    # the pipeline functions modify their inputs, so every run gets its own copy
+    return lambda func: lambda: func(*[frame.copy() for frame in frames])
+
+
+def benchmark_preprocess(fp, repeat):
+    results = []
+    dataset, result = measure("01 load", schema.read, fp, repeat=repeat)
+    results.append(result)
+
+    dataset["start_date"] = preprocessing.find_start_date(dataset)
+    episodes, result = measure(
+        "01 find_episodes", preprocessing.find_episodes, dataset, repeat=repeat
+    )
+    results.append(result)
+
+    selected, result = measure(
+        "01 select",
+        copies(dataset, episodes)(preprocessing.select),
+        repeat=repeat,
+    )
+    results.append(result)
+
+    possible, result = measure(
+        "01 select_possible",
+        copies(dataset, episodes)(preprocessing.select_possible),
+        repeat=repeat,
+    )
+    results.append(result)
+
+    baseline, result = measure(
+        "01 find_baseline_entry",
+        copies(selected)(preprocessing.find_baseline_entry),
+        repeat=repeat,
+    )
+    results.append(result)
+
+    def endpoints(baseline, selected):
+        timeline = preprocessing.build_timeline(baseline, selected)
+        return (
+            preprocessing.determine_benefit(timeline, baseline),
+            preprocessing.determine_response(timeline, baseline),
+        )
+
+    _, result = measure(
+        "01 determine_benefit/response",
+        copies(baseline, selected)(endpoints),
+        repeat=repeat,
+    )
+    results.append(result)
+
+    last_contact = dataset[~dataset["datlcont"].isna()].groupby("upn").datlcont.max()
+    _, result = measure(
+        "01 preprocess",
+        lambda: preprocessing.preprocess(baseline.copy(), selected, last_contact),
+        repeat=repeat,
+    )
+    results.append(result)
+
+    _, result = measure(
+        "01 build_cohorts",
+        copies(dataset.drop(columns=["start_date"]))(preprocessing.build_cohorts),
+        repeat=repeat,
+    )
+    results.append(result)
+
+    if importlib.util.find_spec("polars") is not None:
+        _, result = measure(
+            "01 build_cohorts (polars)",
+            lambda: preprocessing.build_cohorts(
+                dataset.drop(columns=["start_date"]), backend="polars"
+            ),
+            repeat=repeat,
+        )
+        results.append(result)
+
+    return results
+
+
+def compare_backends(dataset):
+    # both backends have to give the same cohorts and funnel on the same input
+    cohorts = {}
+    funnels = {}
+    for backend in ["pandas", "polars"]:
+        funnels[backend] = {}
+        cohorts[backend] = preprocessing.build_cohorts(
+            dataset.copy(), funnels[backend], backend
+        )
+
+    for expected, actual in zip(cohorts["pandas"], cohorts["polars"]):
+        pd.testing.assert_frame_equal(actual, expected)
+    assert funnels["polars"] == funnels["pandas"], (
+        funnels["pandas"],
+        funnels["polars"],
+    )
+
+
+def check_backends(rows, seed):
+    with tempfile.TemporaryDirectory() as folder:
+        fp = Path(folder) / "full.csv"
+        synthetic.generate(rows, seed).to_csv(fp, index=False)
+        compare_backends(schema.read(fp))
+
+
+def check_coding():
+    # the upns of a center match the coding file whether it wrote them as floats or with leading zeros
+    center = pd.Series([123, 456, 12345], name="upn")
+    for written in [["123.0", "456.0", "12345.0"], ["0000123", "0000456", "0012345"]]:
+        with tempfile.TemporaryDirectory() as folder:
+            fp = Path(folder) / "coding.csv"
+            pd.DataFrame({"upn": written, "premium_id": ["P1", "P2", "P3"]}).to_csv(
+                fp, index=False
+            )
+            coding = anonymization.load_coding(fp)
+            ids = anonymization.normalize_upn(center).map(coding).tolist()
+            assert ids == ["P1", "P2", "P3"], (written, ids)
+
+
+def benchmark_anonymize(config, repeat):
+    datasets = [name + ".csv" for name in config["names"].values()]
+    (blocks, _), result = measure(
+        "02 anonymize_centers",
+        anonymization.anonymize_centers,
+        datasets,
+        config,
+        repeat=repeat,
+    )
+
+    dmtr = pd.concat(pd.read_pickle(block) for block in blocks)
+    dmtr = dmtr[~dmtr.id.isna()].set_index("id")
+    return dmtr, [result]
+
+
+def benchmark_update(original_dmtr, repeat, seed):
+    # the updated extract has longer followup for most patients, and some patients were renumbered
+    rng = np.random.default_rng(seed)
+    updated_dmtr = original_dmtr.copy()
+    renumbered = rng.random(len(updated_dmtr)) < 0.05
+    updated_dmtr.index = np.where(
+        renumbered, updated_dmtr.index + "_NEW", updated_dmtr.index
+    )
+    updated_dmtr.index.name = "id"
+    updated_dmtr["dcb"] = updated_dmtr["dcb"].fillna(
+        pd.Series(rng.integers(0, 2, len(updated_dmtr)), index=updated_dmtr.index)
+    )
+
+    labelled = original_dmtr.index[rng.random(len(original_dmtr)) < 0.1]
+    missing_patient_level_labels = pd.DataFrame(
+        {
+            "dcb": rng.integers(0, 2, len(labelled)),
+            "response": rng.integers(0, 2, len(labelled)),
+        },
+        index=pd.Index(labelled, name="patient"),
+    )
+
+    results = []
+    all_matched, result = measure(
+        "03 match", update.match, original_dmtr, updated_dmtr, repeat=repeat
+    )
+    results.append(result)
+
+    _, result = measure(
+        "03 merge_endpoints",
+        update.merge_endpoints,
+        original_dmtr,
+        all_matched,
+        missing_patient_level_labels,
+        repeat=repeat,
+    )
+    results.append(result)
+
+    return results
+
+
+def run(rows, seed, repeat):
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        (folder / "input").mkdir()
+        (folder / "intermediate").mkdir()
+
+        dataset = synthetic.generate(rows, seed, centers=len(CENTERS))
+        names = synthetic.write(dataset, folder / "input", CENTERS)
+        synthetic.coding(dataset, seed=seed).to_csv(folder / "coding.csv", index=False)
+        config = {
+            "input_folder": str(folder / "input"),
+            "intermediate_output_folder": str(folder / "intermediate"),
+            "upn_to_study_coding": str(folder / "coding.csv"),
+            "names": names,
+            "already_encoded": [],
+            "include_with_other_therapy": {fp: [] for fp in names},
+        }
+
+        # the single-center stages run on the full dataset as if it were one center
+        full = folder / "full.csv"
+        dataset.drop(columns=["center"]).to_csv(full, index=False)
+        results = benchmark_preprocess(full, repeat)
+
+        for fp in (folder / "input").iterdir():
+            with contextlib.redirect_stdout(io.StringIO()):
+                preprocessing.process_center(fp, config, {})
+
+        dmtr, anonymize_results = benchmark_anonymize(config, repeat)
+        results += anonymize_results
+        results += benchmark_update(dmtr, repeat, seed)
+
+    return {
+        "rows": len(dataset),
+        "patients": dataset["upn"].nunique(),
+        "stages": results,
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000]
+)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument(
+    "--output",
+    default="benchmark_results.json",
+    help="json file the results are appended to, so that runs on different commits can be compared",
+)
+parser.add_argument(
+    "--check-backends",
+    action="store_true",
+    help="only check that the pandas and polars backends select the same cohorts",
+)
+parser.add_argument(
+    "--check-coding",
+    action="store_true",
+    help="only check that upns match the coding file however either file wrote them",
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.check_coding:
+        check_coding()
+        print("the upns match the coding file")
+        raise SystemExit
+
+    if args.check_backends:
+        for rows in args.rows:
+            check_backends(rows, args.seed)
+            print("{} rows: the backends give the same cohorts".format(rows))
+        raise SystemExit
+
+    output = Path(args.output)
+    history = json.loads(output.read_text()) if output.exists() else []
+
+    for rows in args.rows:
+        result = {
+            "commit": commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "seed": args.seed,
+            **run(rows, args.seed, args.repeat),
+        }
+        history.append(result)
+        output.write_text(json.dumps(history, indent=2))
+
+        print("#" * 100)
+        print("{} rows, {} patients".format(result["rows"], result["patients"]))
+        print(pd.DataFrame(result["stages"]).to_string(index=False))
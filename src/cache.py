@@ -0,0 +1,101 @@
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+# parsed frames are stored as pickles: unlike feather/parquet they keep every dtype,
+# including the mixed object columns that are common in the raw DMTR exports
+DEFAULT_FOLDER = "../cache"
+DEFAULT_MAX_SIZE_GB = 10
+
+
+@lru_cache(maxsize=None)
+def _file_hash(path, size, mtime_ns):
+    # size and mtime are part of the arguments so the hash is recomputed when the file changes
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_hash(fp):
+    stat = os.stat(fp)
+    return _file_hash(str(Path(fp).resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+def cache_key(fp, reader, options):
+    key = "|".join(
+        [
+            file_hash(fp),
+            reader.__name__,
+            repr(sorted(options.items())),
+            pd.__version__,
+        ]
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def evict(cache_folder, max_size_gb):
+    # remove the least recently used entries until the cache fits within its size limit. Other
+    # processes may remove entries at the same time, those are skipped
+    entries = []
+    for entry in Path(cache_folder).glob("*.pkl"):
+        try:
+            entries.append((entry.stat(), entry))
+        except FileNotFoundError:
+            continue
+    entries.sort(key=lambda item: item[0].st_mtime)
+
+    total = sum(stat.st_size for stat, _ in entries)
+    while entries and total > max_size_gb * 1024**3:
+        stat, entry = entries.pop(0)
+        total -= stat.st_size
+        entry.unlink(missing_ok=True)
+
+
+def read(
+    fp, cache_folder=None, max_size_gb=DEFAULT_MAX_SIZE_GB, reader=None, **options
+):
+    # read an excel or csv file, reusing the parsed frame of an earlier run if the contents did not change.
+    # reader can be any function that takes the file path and the options, e.g. to read several sheets at once
+    fp = Path(fp)
+    if reader is None:
+        reader = pd.read_excel if fp.name.endswith(".xlsx") else pd.read_csv
+    if cache_folder is None:
+        return reader(fp, **options)
+
+    cache_folder = Path(cache_folder)
+    entry = cache_folder / (cache_key(fp, reader, options) + ".pkl")
+    try:
+        os.utime(entry)
+        return pd.read_pickle(entry)
+    except FileNotFoundError:
+        # not cached, or evicted by another process in the meantime
+        pass
+
+    df = reader(fp, **options)
+
+    # every process writes to its own temporary file, so that workers caching the same file do not
+    # write to the same path
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=cache_folder, suffix=".tmp", delete=False
+    ) as partial:
+        pd.to_pickle(df, partial)
+    Path(partial.name).replace(entry)
+    evict(cache_folder, max_size_gb)
+
+    return df
+
+
+def options_from_config(config, no_cache=False):
+    if no_cache:
+        return {"cache_folder": None}
+    return {
+        "cache_folder": config.get("cache_folder") or DEFAULT_FOLDER,
+        "max_size_gb": config.get("cache_max_size_gb") or DEFAULT_MAX_SIZE_GB,
+    }
@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import pandas as pd
+
+from cache import file_hash
+
+# per patient content hashes of an extract, to find the patients that were added, removed or
+# changed since the previous extract. The hashes are kept together with hashes of the outputs they
+# were computed with, so that the outputs can be updated for the changed patients only.
+KEY = "upn"
+
+
+def _normalized(column):
+    # the same value hashes the same whether the column was read as int, float or text
+    if pd.api.types.is_numeric_dtype(column):
+        return column.astype("float64")
+    return column.astype("string")
+
+
+def patient_hashes(dataset, key=KEY):
+    # a patient's hash is the sum of the hashes of its rows, so it does not depend on the row order
+    columns = sorted(c for c in dataset.columns if c != key)
+    rows = pd.util.hash_pandas_object(dataset[columns].apply(_normalized), index=False)
+    hashes = rows.groupby(dataset[key].to_numpy()).sum()
+    hashes.index.name = key
+    return hashes
+
+
+def diff(previous, current):
+    # the change of every patient that was added, removed or changed
+    common = current.index.intersection(previous.index)
+    changed = common[current.loc[common].to_numpy() != previous.loc[common].to_numpy()]
+    changes = pd.concat(
+        [
+            pd.Series("added", index=current.index.difference(previous.index)),
+            pd.Series("removed", index=previous.index.difference(current.index)),
+            pd.Series("changed", index=changed),
+        ]
+    )
+    changes.index.name = previous.index.name
+    return changes.rename("change")
+
+
+def state_path(folder, name):
+    return Path(folder) / "delta" / (name + ".pkl")
+
+
+def load(folder, name, outputs):
+    # the hashes of the previous run, or None when the outputs were changed since
+    fp = state_path(folder, name)
+    if not fp.exists() or not all(Path(output).exists() for output in outputs):
+        return None
+    state = pd.read_pickle(fp)
+    if state["outputs"] != [file_hash(output) for output in outputs]:
+        return None
+    return state["hashes"]
+
+
+def save(folder, name, hashes, outputs):
+    fp = state_path(folder, name)
+    fp.parent.mkdir(exist_ok=True)
+    pd.to_pickle(
+        {"hashes": hashes, "outputs": [file_hash(output) for output in outputs]}, fp
+    )
+
+
+def same_columns(outputs, cohorts):
+    # whether the recomputed rows have the columns of the previous outputs. Empty frames stand for
+    # cohorts without recomputed rows, which fit any output.
+    for fp, cohort in zip(outputs, cohorts):
+        header = pd.read_csv(fp, nrows=0).columns
+        if len(cohort.columns) and list(header[1:]) != list(cohort.columns):
+            return False
+    return True
+
+
+def update_output(fp, cohort, patients):
+    # the rows of the previous output for the patients that are not in patients, followed by the
+    # recomputed rows. The previous rows are kept as text so they are written back unchanged.
+    previous = pd.read_csv(fp, dtype=str, keep_default_na=False)
+    previous = previous.set_index(previous.columns[0])
+    previous = previous[~previous.index.isin(pd.Index(patients).astype(str))]
+    previous.to_csv(fp)
+    cohort.reindex(columns=previous.columns).to_csv(fp, mode="a", header=False)
+    return len(previous) + len(cohort)
+
+
+def write_changes(folder, name, changes):
+    fp = state_path(folder, name).with_name(name + "_changes.csv")
+    fp.parent.mkdir(exist_ok=True)
+    changes.to_csv(fp)
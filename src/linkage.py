@@ -0,0 +1,76 @@
+import pandas as pd
+
+# links the patients of two dmtr exports that could not be matched on their id, e.g. because they
+# were renumbered between the exports. Only pairs that share the cheap blocking keys are compared,
+# so the work grows with the size of the blocks instead of with the product of both exports. The
+# candidates are scored on how close their dates are, and every patient is linked at most once.
+
+BLOCKS = ["center", "gebjaar"]
+DATES = ["datprim", "start_date"]
+TOLERANCE_DAYS = 14
+
+
+def candidates(original, updated, blocks=BLOCKS, dates=DATES):
+    # all pairs within a block, as positions into original and updated
+    def keys(df):
+        keys = df[blocks + dates].reset_index(drop=True)
+        for date in dates:
+            keys[date] = pd.to_datetime(keys[date], errors="coerce")
+        keys.index.name = "row"
+        return keys.dropna(subset=blocks).reset_index()
+
+    return keys(original).merge(
+        keys(updated), on=blocks, suffixes=("_original", "_updated")
+    )
+
+
+def score(pairs, dates=DATES, tolerance_days=TOLERANCE_DAYS):
+    # every date adds 1 when it is the same in both exports, down to 0 at the tolerance. Pairs with a
+    # date that is missing or further apart than the tolerance are dropped.
+    within = pd.Series(True, index=pairs.index)
+    total = pd.Series(0.0, index=pairs.index)
+    for date in dates:
+        days = (pairs[f"{date}_original"] - pairs[f"{date}_updated"]).dt.days.abs()
+        within &= days <= tolerance_days
+        total += 1 - days / (tolerance_days + 1)
+
+    pairs = pairs.assign(score=total / len(dates))[within]
+    return pairs[["row_original", "row_updated", "score"]]
+
+
+def assign(pairs):
+    # one-to-one links, best scores first. Every round links the pairs that are the best candidate of
+    # their original patient and the best of those for their updated patient, and removes the patients
+    # that were linked from the remaining candidates.
+    pairs = pairs.sort_values(
+        ["score", "row_original", "row_updated"],
+        ascending=[False, True, True],
+        kind="stable",
+    )
+    linked = []
+    while len(pairs):
+        best = pairs.drop_duplicates("row_original").drop_duplicates("row_updated")
+        linked.append(best)
+        pairs = pairs[
+            ~pairs["row_original"].isin(best["row_original"])
+            & ~pairs["row_updated"].isin(best["row_updated"])
+        ]
+
+    if not linked:
+        return pairs
+    return pd.concat(linked).sort_values(["row_original", "row_updated"])
+
+
+def link(
+    original,
+    updated,
+    blocks=BLOCKS,
+    dates=DATES,
+    tolerance_days=TOLERANCE_DAYS,
+):
+    # the match table: the id and position of both patients of every link, and its score
+    pairs = score(candidates(original, updated, blocks, dates), dates, tolerance_days)
+    links = assign(pairs).reset_index(drop=True)
+    links.insert(0, "id_original", original.index[links["row_original"]])
+    links.insert(1, "id_updated", updated.index[links["row_updated"]])
+    return links
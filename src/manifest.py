@@ -0,0 +1,55 @@
+import hashlib
+import json
+from pathlib import Path
+
+from cache import file_hash
+
+# the manifest records, for every output of a numbered script, everything the output was
+# computed from: hashes of the input files, the slices of the config that were used and the
+# version of the code. An output is up to date when all of these are unchanged.
+FILENAME = "manifest.json"
+
+
+def load(folder):
+    fp = Path(folder) / FILENAME
+    if not fp.exists():
+        return {}
+    with open(fp) as f:
+        return json.load(f)
+
+
+def save(folder, manifest):
+    fp = Path(folder) / FILENAME
+    partial = fp.with_suffix(".tmp")
+    with open(partial, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True, default=str)
+    partial.replace(fp)
+
+
+def code_version(*files):
+    digest = hashlib.sha256()
+    for fp in files:
+        digest.update(file_hash(fp).encode())
+    return digest.hexdigest()
+
+
+def record(inputs, config, code):
+    # inputs maps a role to a file path, config holds the config values the output depends on
+    return {
+        "inputs": {
+            role: file_hash(fp) if fp is not None and Path(fp).exists() else None
+            for role, fp in inputs.items()
+        },
+        "config": json.loads(json.dumps(config, sort_keys=True, default=str)),
+        "code": code,
+    }
+
+
+def is_up_to_date(manifest, stage, key, current, outputs):
+    return manifest.get(stage, {}).get(key) == current and all(
+        Path(fp).exists() for fp in outputs
+    )
+
+
+def update(manifest, stage, key, current):
+    manifest.setdefault(stage, {})[key] = current
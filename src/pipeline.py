@@ -0,0 +1,153 @@
+import argparse
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+
+import cache
+import schema
+
+merging = importlib.import_module("00_merge_sheets")
+preprocessing = importlib.import_module("01_preprocess")
+anonymization = importlib.import_module("02_anonymize")
+updating = importlib.import_module("03_update_original")
+
+# the numbered scripts chained as functions over dataframes. The scripts hand their results to the
+# next step through csv files, which loses the dtypes of e.g. the dates, durations and followup
+# lists. Here the frames are kept in memory between the steps, and the intermediate files are only
+# written when asked for, in a background thread.
+
+
+def merge(fp, cache_options=None, sheet_columns=None, aggregate=False):
+    return merging.merge_workbook(fp, cache_options, sheet_columns, aggregate)
+
+
+def prepare(dataset, passthrough=None, date_format=schema.DATE_FORMAT):
+    # the columns and dtypes that schema.read gives for a merged file
+    dataset = dataset[schema.usecols(dataset.columns, passthrough)].copy()
+    return schema.parse_dates(schema.compact(dataset), date_format)
+
+
+def preprocess(dataset):
+    # the included and possible cohorts of a center, with the upn as a column like in the csv files
+    baseline, possible_baseline = preprocessing.build_cohorts(dataset)
+    return baseline.reset_index(), possible_baseline.reset_index()
+
+
+def anonymize(cohorts, config, coding=None):
+    # cohorts maps the file name of a center in the intermediate_output_folder, e.g. center_A.csv,
+    # to its included and possible cohorts
+    if coding is None and any(fp not in config["already_encoded"] for fp in cohorts):
+        coding = anonymization.load_coding(config["upn_to_study_coding"])
+
+    stack = [
+        anonymization.anonymize_center(fp, config, coding, baseline, possible_baseline)
+        for fp, (baseline, possible_baseline) in cohorts.items()
+    ]
+    return anonymization.combine_centers(stack)
+
+
+def update(original_dmtr, updated_dmtr, missing_patient_level_labels):
+    all_matched = updating.match(original_dmtr, updated_dmtr)
+    return updating.merge_endpoints(
+        original_dmtr, all_matched, missing_patient_level_labels
+    )
+
+
+def read_inputs(config, cache_options=None, from_workbooks=False, write=None):
+    # yields the file name in the input_folder and the dataset of every center. Without
+    # passthrough_columns every column is kept, like the output of 01_preprocess.py
+    passthrough = config.get("passthrough_columns")
+    if passthrough is None:
+        passthrough = "all"
+    date_format = config.get("date_format") or schema.DATE_FORMAT
+
+    if not from_workbooks:
+        for fp in Path(config["input_folder"]).iterdir():
+            yield fp.name, schema.read(fp, passthrough, date_format, cache_options)
+        return
+
+    for fp in Path(config["multiple_sheet_files_folder"]).iterdir():
+        merged = merge(fp, cache_options, config.get("sheet_columns"))
+        save_path = Path(config["input_folder"]) / (fp.stem + ".csv")
+        if write:
+            write(merged, save_path)
+        yield save_path.name, prepare(merged, passthrough, date_format)
+
+
+def run(
+    config,
+    cache_options=None,
+    from_workbooks=False,
+    write_intermediates=False,
+    corrections=None,
+):
+    output_folder = Path(config["intermediate_output_folder"])
+    writer = ThreadPoolExecutor(max_workers=1) if write_intermediates else None
+    pending = []
+
+    def write(df, fp, **kwargs):
+        # intermediate files are written in the background while the next center is processed
+        if writer:
+            pending.append(writer.submit(df.to_csv, fp, **kwargs))
+
+    try:
+        cohorts = {}
+        for input_name, dataset in read_inputs(
+            config, cache_options, from_workbooks, write
+        ):
+            print("#" * 100)
+            print("Processing dataset {} ...".format(input_name))
+            name = config["names"][input_name]
+            baseline, possible_baseline = preprocess(dataset)
+            cohorts[name + ".csv"] = (baseline, possible_baseline)
+
+            write(baseline, output_folder / (name + ".csv"), index=False)
+            write(
+                possible_baseline, output_folder / (name + "_possible.csv"), index=False
+            )
+
+        dmtr = anonymize(cohorts, config)
+        if corrections:
+            dmtr = anonymization.apply_corrections(
+                dmtr, anonymization.load_corrections(corrections)
+            )
+    finally:
+        if writer:
+            writer.shutdown(wait=True)
+
+    # raise any error that happened while writing
+    for future in pending:
+        future.result()
+
+    return dmtr
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("config_name")
+parser.add_argument(
+    "--from-workbooks",
+    action="store_true",
+    help="start from the workbooks in multiple_sheet_files_folder instead of the files in input_folder",
+)
+parser.add_argument(
+    "--write-intermediates",
+    action="store_true",
+    help="also write the merged and preprocessed files of every center, like the numbered scripts do",
+)
+parser.add_argument("--no-cache", action="store_true")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with open(f"../config/{args.config_name}") as f:
+        config = yaml.safe_load(f)
+
+    dmtr = run(
+        config,
+        cache.options_from_config(config, args.no_cache),
+        from_workbooks=args.from_workbooks,
+        write_intermediates=args.write_intermediates,
+        corrections=anonymization.find_corrections(config, args.config_name),
+    )
+    dmtr.to_csv(config["output_file"])
@@ -0,0 +1,105 @@
+import contextlib
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+
+# lightweight instrumentation of the pipeline stages. While a profile is active, every stage
+# records its wall time, peak traced memory and rows in and out, and the selection steps record
+# how many patients they exclude. Outside of a profile the stages are not measured at all.
+# Memory is traced with tracemalloc, which slows down the run, so only compare the timings of
+# profiled runs with each other.
+FOLDER = "profile"
+
+_report = None
+
+
+def start(**labels):
+    global _report
+    _report = {**labels, "stages": [], "funnel": {}}
+    tracemalloc.start()
+    return _report
+
+
+def stop():
+    global _report
+    report = _report
+    tracemalloc.stop()
+    _report = None
+    return report
+
+
+@contextlib.contextmanager
+def profile(enabled=True, **labels):
+    if not enabled:
+        yield None
+        return
+
+    report = start(**labels)
+    try:
+        yield report
+    finally:
+        stop()
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None, **labels):
+    # the caller sets record["rows_out"] once the output of the stage is known
+    if _report is None:
+        yield {}
+        return
+
+    record = {"stage": name, **labels, "rows_in": rows_in, "rows_out": None}
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        record["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024**2, 2)
+        _report["stages"].append(record)
+
+
+def funnel(step, patients):
+    if _report is not None:
+        _report["funnel"][step] = int(patients)
+
+
+def write(report, folder, name):
+    fp = Path(folder) / FOLDER / (name + ".json")
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    with open(fp, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    return fp
+
+
+def summarize(reports, folder, name="summary"):
+    # all reports are written to one file, and the seconds of every stage are printed as a table
+    # with one row per report, so that a slow stage stands out
+    write({"reports": reports}, folder, name)
+
+    labels = (
+        [key for key in reports[0] if key not in ["stages", "funnel"]]
+        if reports
+        else []
+    )
+    stages = pd.DataFrame(
+        [
+            {**{label: report.get(label) for label in labels}, **record}
+            for report in reports
+            for record in report["stages"]
+        ]
+    )
+    if len(stages) == 0:
+        return stages
+
+    # stages that run once per cohort are added up
+    table = stages.pivot_table(
+        index=labels, columns="stage", values="seconds", aggfunc="sum", sort=False
+    )
+    table["total"] = table.sum(axis=1)
+    print("#" * 100)
+    print(table.to_string())
+    return stages
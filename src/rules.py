@@ -0,0 +1,30 @@
+# the rules that select the cohorts, shared by the pandas code in 01_preprocess.py and by
+# polars_backend.py, so that both backends select the same patients
+
+# the typsyth1 codes of the therapies that are told apart
+THERAPIES = {
+    "anti_pd1": [5, 6],
+    "other_therapy": [7],
+    "prior_therapy": [2, 3, 4, 10],
+}
+
+# per cohort, the therapy an episode is selected on, and the therapies that make the episodes of a
+# patient after it pretreated
+TREATMENT_LINES = {
+    "included": ("anti_pd1", ["anti_pd1", "other_therapy", "prior_therapy"]),
+    "possible": ("other_therapy", ["anti_pd1", "prior_therapy"]),
+}
+
+# per cohort, the rows that are excluded after the treatment lines are selected, as the step in the
+# funnel, the column and the condition on it
+EXCLUSIONS = {
+    "included": [
+        ("With ocular or mucosal melanoma", "ptloc", "isin", [1, 6]),
+        ("Treated before 1-1-2016", "start_date", "before", "2016-01-01"),
+        ("Treated in (neo-)adjuvant setting", "sysadj", "notnull", None),
+    ],
+    "possible": [
+        ("Treated before 1-1-2016", "start_date", "before", "2016-01-01"),
+        ("Treated in (neo-)adjuvant setting", "sysadj", "notnull", None),
+    ],
+}
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import cache
+
+# columns used by the selection and endpoint rules. Coded fields only take a handful of values
+# and are stored as categoricals, the patient number is stored as a string.
+KEYS = ["upn", "episodevolgnr"]
+CODED = [
+    "typsyth1",
+    "statlcont",
+    "ptloc",
+    "sysadj",
+    "doodoorz",
+    "locafmethersen",
+    "locafmetlever",
+    "locafmetdarm",
+    "locafmetbot",
+    "locafmetand",
+    "locafmetlong",
+    "locafmetlklier",
+    "locafmetcutis",
+    "lokrec",
+    "geslacht",
+    "who",
+    "stagepet",
+    "labdlhd",
+]
+DATES = [
+    "startpd",
+    "startipnicomb",
+    "startandst",
+    "datlcont",
+    "datovl",
+    "gebdat",
+    "datprim",
+]
+# dates in csv files are written as ISO 8601 by the earlier steps, excel files already contain typed dates
+DATE_FORMAT = "ISO8601"
+# columns that are not used by the rules themselves, but are needed by the later steps
+PASSTHROUGH = ["id", "gebjaar", "typandst"]
+
+COLUMNS = KEYS + CODED + DATES + PASSTHROUGH
+# rows per chunk when a csv file is streamed, e.g. to partition it into buckets
+CHUNKSIZE = 100_000
+
+
+def compact(df):
+    df["upn"] = df["upn"].astype(str).astype("string")
+    for col in CODED:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def parse_dates(df, date_format=DATE_FORMAT):
+    for col in DATES:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], format=date_format)
+    return df
+
+
+def expand(df):
+    # restore the plain dtypes of the coded fields, e.g. once a frame is reduced to one row per patient
+    for col in CODED:
+        if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+
+def usecols(header, passthrough=None):
+    if passthrough == "all":
+        return list(header)
+    columns = set(COLUMNS) | set(passthrough or [])
+    return [col for col in header if col in columns]
+
+
+def read_parquet(fp, passthrough=None):
+    # parquet files keep their dtypes and are read by column, so they are not cached
+    import pyarrow.parquet
+
+    header = pyarrow.parquet.read_schema(fp).names
+    return pd.read_parquet(fp, columns=usecols(header, passthrough))
+
+
+def read(fp, passthrough=None, date_format=DATE_FORMAT, cache_options=None, dtype=None):
+    # read only the columns in the schema, plus the passthrough columns that are asked for.
+    # passthrough="all" keeps every column of the file. The other columns can be read later for
+    # the rows that are needed with read_rows.
+    cache_options = cache_options or {}
+    if Path(fp).suffix == ".parquet":
+        return parse_dates(compact(read_parquet(fp, passthrough)), date_format)
+
+    if passthrough == "all":
+        df = cache.read(fp, dtype=dtype, **cache_options)
+        return parse_dates(compact(df), date_format)
+
+    header = cache.read(fp, nrows=0, **cache_options).columns
+    df = cache.read(
+        fp, usecols=usecols(header, passthrough), dtype=dtype, **cache_options
+    )
+    return parse_dates(compact(df), date_format)
+
+
+def _inferred_dtype(values):
+    try:
+        return pd.to_numeric(values).dtype
+    except (ValueError, TypeError):
+        return np.dtype(object)
+
+
+def _infer_dtypes(dtypes, chunk):
+    # widen the dtypes inferred so far with those of a chunk that was read as text
+    for col in chunk.columns:
+        dtype = _inferred_dtype(chunk[col])
+        dtypes[col] = np.result_type(dtypes.get(col, dtype), dtype)
+
+
+def read_rows(fp, rows, dtype=None, chunksize=CHUNKSIZE):
+    # every column of the given rows of a csv file, for the columns that are not read up front.
+    # The file is streamed in chunks so that only these rows are kept in memory, and the columns
+    # get the dtypes that read_csv would have inferred for the whole file, unless dtype is given.
+    chunks = pd.read_csv(fp, dtype=str if dtype is None else dtype, chunksize=chunksize)
+
+    dtypes = {}
+    kept = []
+    for chunk in chunks:
+        if dtype is None:
+            _infer_dtypes(dtypes, chunk)
+        kept.append(chunk[chunk.index.isin(rows)])
+
+    df = pd.concat(kept)
+    return df.astype(dtypes) if dtype is None else df
+
+
+def partition(fp, folder, buckets, passthrough=None, chunksize=CHUNKSIZE):
+    # stream a csv file in chunks and split its rows over bucket files by a hash of the upn, so
+    # that all rows of a patient end up in the same bucket. Returns the bucket files and the
+    # dtypes that read_csv would have inferred for the whole file, so that every bucket is read
+    # back with the same dtypes.
+    header = pd.read_csv(fp, nrows=0).columns
+    chunks = pd.read_csv(
+        fp, usecols=usecols(header, passthrough), dtype=str, chunksize=chunksize
+    )
+
+    dtypes = {}
+    fps = {}
+    for chunk in chunks:
+        _infer_dtypes(dtypes, chunk)
+
+        bucket = pd.util.hash_pandas_object(chunk["upn"], index=False) % buckets
+        for i, rows in chunk.groupby(bucket.to_numpy()):
+            bucket_fp = fps.setdefault(i, Path(folder) / "bucket_{}.csv".format(i))
+            rows.to_csv(bucket_fp, mode="a", header=not bucket_fp.exists(), index=False)
+
+    dtypes = {col: dtype for col, dtype in dtypes.items() if col not in DATES}
+    return [fps[i] for i in sorted(fps)], dtypes
@@ -0,0 +1,256 @@
+import argparse
+import contextlib
+import importlib
+import io
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+import cache
+
+merging = importlib.import_module("00_merge_sheets")
+preprocessing = importlib.import_module("01_preprocess")
+anonymization = importlib.import_module("02_anonymize")
+updating = importlib.import_module("03_update_original")
+
+# the numbered scripts as a graph of stages. Every stage declares the files it reads and writes and
+# the stages that have to run before it. A stage is skipped when all of its outputs are newer than
+# its inputs and the config, so that a refresh only redoes the stages that a change affects. The
+# stages of different centers do not depend on each other, and run in parallel with --workers.
+
+Stage = namedtuple("Stage", ["name", "task", "inputs", "outputs", "after"])
+
+
+def merge(fp, config, cache_options):
+    merging.merge_file(fp, config, cache_options)
+
+
+def preprocess(fp, config, cache_options):
+    preprocessing.process_center(fp, config, cache_options)
+
+
+def anonymize(config, config_name):
+    anonymization.run(config, config_name)
+
+
+def update(config, original_config, labels_fp, output_fp):
+    updating.update_original(config, original_config, labels_fp, output_fp)
+
+
+def config_path(config_name):
+    # a path to a config file, or the name of a config in the config folder like the scripts take
+    fp = Path(config_name)
+    return fp if fp.exists() else Path("../config") / config_name
+
+
+def load_config(fp):
+    with open(fp) as f:
+        return yaml.safe_load(f)
+
+
+def build_stages(config, config_fp, cache_options=None):
+    input_folder = Path(config["input_folder"])
+    stages = []
+
+    # the merged workbooks are written to the input_folder, where the preprocessing picks them up
+    merged = {}
+    if config.get("multiple_sheet_files_folder"):
+        for fp in sorted(Path(config["multiple_sheet_files_folder"]).iterdir()):
+            output = input_folder / (fp.stem + ".csv")
+            merged[output.name] = "merge " + fp.name
+            stages.append(
+                Stage(
+                    merged[output.name],
+                    (merge, (fp, config, cache_options)),
+                    [fp],
+                    [output],
+                    [],
+                )
+            )
+
+    preprocessed = []
+    anonymize_inputs = []
+    for input_name in config["names"]:
+        fp = input_folder / input_name
+        outputs = preprocessing.center_outputs(fp, config)
+        preprocessed.append("preprocess " + input_name)
+        anonymize_inputs.extend(outputs)
+        stages.append(
+            Stage(
+                preprocessed[-1],
+                (preprocess, (fp, config, cache_options)),
+                [fp],
+                outputs,
+                [merged[input_name]] if input_name in merged else [],
+            )
+        )
+
+    if any(fp not in config["already_encoded"] for fp in config["names"]):
+        anonymize_inputs.append(config["upn_to_study_coding"])
+    corrections = anonymization.find_corrections(config, Path(config_fp).name)
+    if isinstance(corrections, str):
+        anonymize_inputs.append(corrections)
+    stages.append(
+        Stage(
+            "anonymize",
+            (anonymize, (config, Path(config_fp).name)),
+            anonymize_inputs,
+            [config["output_file"]],
+            preprocessed,
+        )
+    )
+
+    # the endpoints of this extract are carried over to the original selection when the config
+    # names the config of the original extract
+    settings = config.get("update_original") or {}
+    if settings.get("original_config"):
+        original_fp = Path(config_fp).parent / settings["original_config"]
+        original_config = load_config(original_fp)
+        labels_fp = settings.get("missing_patient_level_labels") or updating.LABELS_FILE
+        output_fp = settings.get("output_file") or updating.OUTPUT_FILE
+        stages.append(
+            Stage(
+                "update",
+                (update, (config, original_config, labels_fp, output_fp)),
+                [
+                    config["output_file"],
+                    original_config["output_file"],
+                    original_fp,
+                    labels_fp,
+                ],
+                [output_fp, updating.matches_path(config)],
+                ["anonymize"],
+            )
+        )
+
+    return stages
+
+
+def is_up_to_date(stage, config_fp):
+    outputs = [Path(fp) for fp in stage.outputs]
+    inputs = [Path(fp) for fp in [*stage.inputs, config_fp]]
+    if not all(fp.exists() for fp in outputs + inputs):
+        return False
+    return min(fp.stat().st_mtime for fp in outputs) >= max(
+        fp.stat().st_mtime for fp in inputs
+    )
+
+
+def run_stage(task):
+    # the output of a stage is captured, so that the logs of parallel stages do not interleave
+    function, args = task
+    log = io.StringIO()
+    start = time.perf_counter()
+    failed = False
+    with contextlib.redirect_stdout(log):
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc(file=log)
+            failed = True
+    return log.getvalue(), failed, round(time.perf_counter() - start, 1)
+
+
+def run(stages, config_fp, workers=1, force=False, dry_run=False):
+    summary = {
+        stage.name: {"stage": stage.name, "status": None, "seconds": float("nan")}
+        for stage in stages
+    }
+    status = {}
+    pending = list(stages)
+    running = {}
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def finish(stage, result):
+        log, failed, seconds = result
+        print("#" * 100)
+        print("Stage {}".format(stage.name))
+        print(log, end="")
+        status[stage.name] = "failed" if failed else "ran"
+        summary[stage.name]["seconds"] = seconds
+
+    while pending or running:
+        for stage in list(pending):
+            after = [status.get(name) for name in stage.after]
+            if None in after:
+                continue
+            pending.remove(stage)
+
+            # a stage runs when a stage before it ran, or when its outputs are older than its inputs
+            if any(s in ["failed", "blocked"] for s in after):
+                status[stage.name] = "blocked"
+            elif (
+                not force
+                and not any(s in ["ran", "would run"] for s in after)
+                and is_up_to_date(stage, config_fp)
+            ):
+                status[stage.name] = "up to date"
+            elif dry_run:
+                status[stage.name] = "would run"
+            elif pool:
+                running[pool.submit(run_stage, stage.task)] = stage
+            else:
+                finish(stage, run_stage(stage.task))
+
+        if running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(running.pop(future), future.result())
+
+    if pool:
+        pool.shutdown()
+
+    for name, record in summary.items():
+        record["status"] = status[name]
+    summary = pd.DataFrame(list(summary.values())).convert_dtypes()
+    print("#" * 100)
+    print(summary.to_string(index=False))
+    return summary
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "config_name",
+    help="path to a config file, or the name of a config in the config folder",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of stages to run in parallel",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="run every stage, also those that are up to date",
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="only show which stages would run",
+)
+parser.add_argument("--no-cache", action="store_true")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config_fp = config_path(args.config_name)
+    config = load_config(config_fp)
+
+    stages = build_stages(
+        config, config_fp, cache.options_from_config(config, args.no_cache)
+    )
+    summary = run(
+        stages,
+        config_fp,
+        workers=args.workers,
+        force=args.force,
+        dry_run=args.dry_run,
+    )
+    if (summary["status"] == "failed").any():
+        sys.exit(1)
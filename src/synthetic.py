@@ -0,0 +1,158 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# a synthetic DMTR export with the structure of the real one: every patient has one or more
+# treatment episodes, and every episode one row per followup assessment (or a single row without
+# followup). The codes follow the DMTR coding used in 01_preprocess.py.
+THERAPIES = [2, 3, 4, 5, 6, 7, 10, np.nan]
+THERAPY_P = [0.1, 0.1, 0.1, 0.3, 0.2, 0.1, 0.05, 0.05]
+STATUSES = [1, 2, 3, 4, 5, 6, 7, 8, np.nan]
+STATUS_P = [0.05, 0.2, 0.15, 0.2, 0.05, 0.15, 0.05, 0.05, 0.1]
+ROWS_PER_PATIENT = 8
+
+
+def _choice(rng, values, size, p=None):
+    return rng.choice(np.array(values, dtype=float), size=size, p=p)
+
+
+def _days(start, offsets):
+    days = np.datetime64(start, "D") + offsets.astype("timedelta64[D]")
+    return days.astype("datetime64[ns]")
+
+
+def generate(n_rows, seed=0, centers=1):
+    # the number of rows is approximate, patients have on average about ROWS_PER_PATIENT rows
+    rng = np.random.default_rng(seed)
+    n_patients = max(1, n_rows // ROWS_PER_PATIENT)
+
+    # patient level
+    upn = (10_000_000 + rng.choice(10 * n_patients, n_patients, replace=False)).astype(
+        str
+    )
+    center = rng.integers(0, centers, n_patients)
+    gebdat = _days("1930-01-01", rng.integers(0, 20_000, n_patients))
+    died = rng.random(n_patients) < 0.4
+    datovl = np.where(
+        died,
+        _days("2016-06-01", rng.integers(0, 2_000, n_patients)),
+        np.datetime64("NaT"),
+    )
+    doodoorz = np.where(died, _choice(rng, [1, 2, 3, 7, np.nan], n_patients), np.nan)
+    ptloc = _choice(rng, [1, 2, 3, 6, np.nan], n_patients, [0.05, 0.4, 0.4, 0.05, 0.1])
+    datprim = _days("2010-01-01", rng.integers(0, 3_000, n_patients))
+
+    # episode level
+    n_episodes = rng.integers(1, 4, n_patients)
+    patient = np.repeat(np.arange(n_patients), n_episodes)
+    e = len(patient)
+    episodevolgnr = (
+        np.arange(e) - np.repeat(np.cumsum(n_episodes) - n_episodes, n_episodes) + 1
+    )
+    start = _days("2014-06-01", rng.integers(0, 2_500, e))
+    episodes = {
+        "typsyth1": _choice(rng, THERAPIES, e, THERAPY_P),
+        "sysadj": np.where(rng.random(e) < 0.1, 1.0, np.nan),
+        "lokrec": _choice(rng, [0, 1], e),
+        "who": _choice(rng, [0, 1, 2, 9], e),
+        "stagepet": _choice(rng, [0, 1], e),
+        "labdlhd": _choice(rng, [0, 1, 2, 9], e),
+        "typandst": np.where(rng.random(e) < 0.1, "other therapy", None),
+    }
+    for col in [
+        "locafmethersen",
+        "locafmetlever",
+        "locafmetdarm",
+        "locafmetbot",
+        "locafmetand",
+        "locafmetlong",
+        "locafmetlklier",
+        "locafmetcutis",
+    ]:
+        episodes[col] = _choice(rng, [0, 1, np.nan], e, [0.7, 0.15, 0.15])
+
+    # the therapy start is recorded in one of the start columns, sometimes also in a second one
+    start_column = rng.integers(0, 3, e)
+    second = rng.random(e) < 0.3
+    for i, col in enumerate(["startpd", "startipnicomb", "startandst"]):
+        other = start + rng.integers(-30, 30, e).astype("timedelta64[D]")
+        episodes[col] = np.where(
+            start_column == i,
+            start,
+            np.where(
+                second & (start_column == (i + 1) % 3), other, np.datetime64("NaT")
+            ),
+        )
+
+    # followup level, episodes without followup keep a single row without assessment
+    n_followup = rng.integers(0, ROWS_PER_PATIENT, e)
+    row_episode = np.repeat(np.arange(e), np.maximum(n_followup, 1))
+    n = len(row_episode)
+    has_followup = n_followup[row_episode] > 0
+    dated = has_followup & (rng.random(n) > 0.05)
+    statlcont = np.where(has_followup, _choice(rng, STATUSES, n, STATUS_P), np.nan)
+    datlcont = np.where(
+        dated,
+        start[row_episode] + rng.integers(-10, 600, n).astype("timedelta64[D]"),
+        np.datetime64("NaT"),
+    )
+
+    row_patient = patient[row_episode]
+    dataset = pd.DataFrame(
+        {
+            "upn": upn[row_patient],
+            "episodevolgnr": episodevolgnr[row_episode],
+            **{col: values[row_episode] for col, values in episodes.items()},
+            "ptloc": ptloc[row_patient],
+            "doodoorz": doodoorz[row_patient],
+            "datovl": datovl[row_patient],
+            "gebdat": gebdat[row_patient],
+            "datprim": datprim[row_patient],
+            "geslacht": _choice(rng, [1, 2], n_patients)[row_patient],
+            "id": np.char.add("SYN_", upn)[row_patient],
+            "statlcont": statlcont,
+            "datlcont": datlcont,
+        }
+    )
+    dataset["center"] = center[row_patient]
+    return dataset
+
+
+def coding(dataset, missing=0.02, seed=0):
+    # a upn to study id coding table, with a fraction of the patients missing
+    rng = np.random.default_rng(seed)
+    upns = pd.unique(dataset["upn"])
+    upns = upns[rng.random(len(upns)) >= missing]
+    return pd.DataFrame(
+        {
+            "upn": upns,
+            "premium_id": ["PREM_SYN_{:06d}".format(i) for i in range(len(upns))],
+        }
+    )
+
+
+def write(dataset, folder, names=None):
+    # write one csv per center, in the layout expected in the input_folder of 01_preprocess.py,
+    # and return the names section of the config
+    config_names = {}
+    for center, rows in dataset.groupby("center"):
+        name = names[center] if names else "center_{}".format(center)
+        rows.drop(columns=["center"]).to_csv(
+            Path(folder) / (name + ".csv"), index=False
+        )
+        config_names[name + ".csv"] = name
+    return config_names
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("output_file")
+parser.add_argument("--rows", type=int, default=10_000)
+parser.add_argument("--seed", type=int, default=0)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    generate(args.rows, args.seed).drop(columns=["center"]).to_csv(
+        args.output_file, index=False
+    )
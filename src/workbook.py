@@ -0,0 +1,75 @@
+from itertools import chain
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.io.parsers import TextParser
+
+# reads several sheets of an excel workbook in a single pass over the file. pd.read_excel opens and
+# unzips the whole workbook again for every sheet, here the workbook is opened once in openpyxl's
+# read-only mode and every sheet is streamed row by row, keeping only the requested columns.
+# Cells are converted the same way as pandas' openpyxl reader does, so the frames are the same as
+# those of pd.read_excel.
+
+
+def _convert(value):
+    if value is None:
+        return ""
+    if type(value) is float:
+        whole = int(value)
+        return whole if whole == value else value
+    if type(value) is str and value in ERROR_CODES:
+        return np.nan
+    return value
+
+
+def _sheet_data(sheet, usecols=None):
+    sheet.reset_dimensions()
+    rows = sheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return []
+    # without usecols every cell is kept, also those to the right of the header, which pandas
+    # reads as Unnamed columns
+    keep = None
+    if usecols is not None:
+        keep = [i for i, col in enumerate(header) if col is not None and col in usecols]
+
+    data = []
+    last_row_with_data = -1
+    for row in chain([header], rows):
+        if keep is None:
+            converted = [_convert(value) for value in row]
+        else:
+            converted = [_convert(row[i]) if i < len(row) else "" for i in keep]
+        while converted and converted[-1] == "":
+            converted.pop()
+        # rows are trimmed on the data in all columns, not only in the columns that are kept
+        if any(value is not None for value in row):
+            last_row_with_data = len(data)
+        data.append(converted)
+    data = data[: last_row_with_data + 1]
+
+    if data:
+        width = max(len(row) for row in data)
+        data = [row + [""] * (width - len(row)) for row in data]
+    return data
+
+
+def _parse(data):
+    if not data:
+        return pd.DataFrame()
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+
+def read_sheets(fp, sheets):
+    # sheets maps a sheet name to the columns to read from it, or None for all columns
+    book = openpyxl.load_workbook(fp, read_only=True, data_only=True)
+    try:
+        return {
+            name: _parse(_sheet_data(book[name], usecols))
+            for name, usecols in sheets.items()
+        }
+    finally:
+        book.close()